@@ -1,29 +1,95 @@
 import asyncio
+import functools
 import json
+import multiprocessing
 import sys
+import time
 import traceback
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
-import grpc.aio
 from dbots import *
 from dbots.cmd import *
 from motor.motor_asyncio import AsyncIOMotorClient
-from xenon.backups import backup_pb2_grpc
-from xenon.mutations import service_pb2_grpc as mutation_pb2_grpc
+from pymongo import monitoring
 
 import config
-from util import PremiumLevel
-
-
-class RpcCollection:
-    def __init__(self):
-        options = [('grpc.max_message_length', 256 * 1024 * 1024)]
-
-        backups_channel = grpc.aio.insecure_channel(config.BACKUPS_SERVICES, options=options)
-        self.backups = backup_pb2_grpc.BackupServiceStub(backups_channel)
-
-        mutations_channel = grpc.aio.insecure_channel(config.MUTATIONS_SERVICE, options=options)
-        self.mutations = mutation_pb2_grpc.MutationServiceStub(mutations_channel)
+from metrics import metrics, CommandStats
+from rpc import RpcCollection
+from util import PremiumLevel, LRUCache, MembershipFilter, InteractionDeadline
+
+# Seconds that the premium level and blacklist entries of a user are cached for
+PRINCIPAL_TTL = 30
+# Redis channels that blacklist and premium changes are published on
+BLACKLIST_CHANNEL = "blacklist"
+PREMIUM_CHANNEL = "premium"
+# Seconds that premium levels are cached for in memory and in redis. Tiers are also changed by external services that
+# don't publish their changes, they are picked up once both caches have expired.
+PREMIUM_TTL = 30
+PREMIUM_REDIS_TTL = 60
+# Seconds between two flushes of the command stats
+STATS_FLUSH_INTERVAL = 5
+# Seconds between two samples of the event loop lag and the redis latency
+MONITOR_INTERVAL = 1
+
+
+class ProcessPool:
+    """
+    Runs CPU heavy functions (e.g. backup compression) in worker processes
+
+    At most max_pending calls are handed to the worker processes at the same time, additional calls wait on the
+    event loop. Arguments and return values are pickled, so they should be plain bytes and builtins.
+    """
+
+    def __init__(self, max_workers, max_pending):
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+        self.semaphore = asyncio.Semaphore(max_pending)
+        self.waiting = 0
+        self.running = 0
+
+        metrics.gauge("process_pool_waiting", lambda: self.waiting)
+        metrics.gauge("process_pool_running", lambda: self.running)
+
+    async def run(self, func, *args):
+        task = func.__name__
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        started_at = time.perf_counter()
+        metrics.observe("process_pool_wait_seconds", started_at - queued_at, task=task)
+        self.running += 1
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(func, *args))
+        except Exception:
+            metrics.inc("process_pool_errors_total", task=task)
+            raise
+        finally:
+            self.running -= 1
+            self.semaphore.release()
+            metrics.observe("process_pool_seconds", time.perf_counter() - started_at, task=task)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Records the latency of every command that is sent to mongodb
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        metrics.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+
+    def failed(self, event):
+        metrics.observe("mongo_command_seconds", event.duration_micros / 1e6, command=event.command_name)
+        metrics.inc("mongo_command_errors_total", command=event.command_name)
 
 
 class Xenon(InteractionBot):
@@ -34,6 +100,11 @@ class Xenon(InteractionBot):
         self._support_invite = None
 
         self.rpc = None
+        self.process_pool = None
+        self.principals = LRUCache("principals", 10000, ttl=PRINCIPAL_TTL)
+        self.blacklist = MembershipFilter()
+        self.premium_levels = LRUCache("premium_levels", 100000, ttl=PREMIUM_TTL)
+        self.stats = CommandStats()
 
         self.component(self._delete_button, name="delete")
 
@@ -64,6 +135,9 @@ class Xenon(InteractionBot):
             elif isinstance(ctx, ModalContext):
                 name = ctx.modal.name
 
+            if name is not None:
+                self.stats.record_error(name)
+
             await self.redis.setex(f"cmd:errors:{error_id}", 60 * 60 * 24, json.dumps({
                 "command": name,
                 "args": args,
@@ -83,7 +157,7 @@ class Xenon(InteractionBot):
                 pass
 
     async def _set_user_entitlement_active(self, member):
-        await self.db.users.update_one(
+        result = await self.db.users.update_one(
             {"_id": member.id},
             {
                 "$set": {
@@ -98,23 +172,177 @@ class Xenon(InteractionBot):
             },
             upsert=True
         )
+        if result.upserted_id is not None:
+            await self.invalidate_premium_level(member.id)
 
-    async def execute_component(self, component, payload, args):
-        premium_level = 0
-        user_doc = await self.db.users.find_one({"_id": payload.author.id})
-        if user_doc is not None:
-            premium_level = user_doc.get("tier", 0)
+    async def _load_blacklist(self):
+        ids = [doc["_id"] async for doc in self.db.blacklist.find(projection=())]
+        self.blacklist = MembershipFilter(ids)
+        self.principals.clear()
+        metrics.set("blacklist_size", len(ids))
+
+    async def _listen(self, channel_name, on_message, on_subscribe):
+        while True:
+            try:
+                channel, = await self.redis.subscribe(channel_name)
+                # Changes could have been missed while not subscribed
+                await on_subscribe()
+                while await channel.wait_message():
+                    on_message(await channel.get_json())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                tb = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+                print(f"Listener Error ({channel_name}):\n", tb, file=sys.stderr)
+
+            await asyncio.sleep(5)
+
+    def _on_blacklist_change(self, change):
+        if change["action"] == "add":
+            self.blacklist.add(change["id"])
+        else:
+            self.blacklist.discard(change["id"])
+
+        self.principals.clear()
+
+    async def _clear_premium_levels(self):
+        self.premium_levels.clear()
+
+    def _on_premium_change(self, change):
+        self.premium_levels.delete(str(change["user"]))
+
+    async def invalidate_premium_level(self, user_id):
+        """
+        Must be called whenever the tier of a user changes, the change is published to all workers
+        """
+        await self.redis.delete(f"premium:tier:{user_id}")
+        await self.redis.publish_json(PREMIUM_CHANNEL, {"user": str(user_id)})
+
+    async def get_premium_level(self, user_id):
+        """
+        Get the premium level of a user
 
-        payload.premium_level = PremiumLevel(premium_level)
-        return await super().execute_component(component, payload, args)
+        Levels are cached in memory and in redis, changes are published on PREMIUM_CHANNEL.
+        """
+        level = self.premium_levels.get(str(user_id))
+        if level is not None:
+            metrics.inc("premium_lookups_total", source="memory")
+            return level
+
+        tier = await self.redis.get(f"premium:tier:{user_id}")
+        if tier is not None:
+            metrics.inc("premium_lookups_total", source="redis")
+        else:
+            metrics.inc("premium_lookups_total", source="database")
+            user_doc = await self.db.users.find_one({"_id": user_id}, projection=("tier",))
+            tier = user_doc.get("tier", 0) if user_doc is not None else 0
+            await self.redis.setex(f"premium:tier:{user_id}", PREMIUM_REDIS_TTL, tier)
+
+        level = PremiumLevel(int(tier))
+        self.premium_levels.set(str(user_id), level)
+        return level
+
+    async def publish_blacklist_change(self, action, _id):
+        # The listener of this worker receives the change too
+        await self.redis.publish_json(BLACKLIST_CHANNEL, {"action": action, "id": str(_id)})
+
+    async def _fetch_principal(self, user_id, guild_id):
+        # Only ids that might be blacklisted have to be looked up, nearly everyone isn't
+        ids = [i for i in (user_id, guild_id) if i and i in self.blacklist]
+        if ids:
+            blacklist, premium_level = await asyncio.gather(
+                self.db.blacklist.find({"_id": {"$in": ids}}).to_list(None),
+                self.get_premium_level(user_id)
+            )
+        else:
+            blacklist = []
+            premium_level = await self.get_premium_level(user_id)
+            metrics.inc("blacklist_lookups_skipped_total")
+
+        blacklist = {doc["_id"]: doc for doc in blacklist}
+        return {
+            "premium_level": premium_level,
+            # The user is checked before the guild
+            "blacklist": blacklist.get(user_id) or blacklist.get(guild_id),
+            "entitlement_active": False
+        }
+
+    async def get_principal(self, payload):
+        """
+        Get the premium level and blacklist entry of the author and guild of an interaction
+
+        All lookups are made concurrently and the result is cached for PRINCIPAL_TTL seconds. The premium level is
+        always read from its own cache because it's invalidated independently.
+        """
+        key = (payload.author.id, payload.guild_id)
+        principal = self.principals.get(key)
+        if principal is None:
+            principal = await self._fetch_principal(payload.author.id, payload.guild_id)
+            self.principals.set(key, principal)
+        else:
+            principal["premium_level"] = await self.get_premium_level(payload.author.id)
+
+        return principal
+
+    async def _flush_stats(self):
+        while True:
+            await asyncio.sleep(STATS_FLUSH_INTERVAL)
+            try:
+                await self.stats.flush(self.redis, config.STATS_WINDOW)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                tb = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+                print("Stats Flush Error:\n", tb, file=sys.stderr)
+
+    async def _monitor(self):
+        while True:
+            scheduled_at = time.perf_counter()
+            await asyncio.sleep(MONITOR_INTERVAL)
+            # The sleep takes longer than requested when the event loop is blocked by other callbacks
+            metrics.set("event_loop_lag_seconds", time.perf_counter() - scheduled_at - MONITOR_INTERVAL)
+            metrics.set("event_loop_tasks", len(asyncio.all_tasks()))
+
+            started_at = time.perf_counter()
+            try:
+                await self.redis.ping()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                metrics.inc("redis_ping_errors_total")
+            else:
+                metrics.observe("redis_ping_seconds", time.perf_counter() - started_at)
+
+    async def execute_component(self, component, payload, args):
+        started_at = time.perf_counter()
+        deadline = payload.deadline = InteractionDeadline(
+            component.name, payload.id,
+            on_finish=lambda seconds: self.stats.record(component.name, seconds, command=False)
+        )
+        try:
+            payload.premium_level = await self.get_premium_level(payload.author.id)
+            return await super().execute_component(component, payload, args)
+        finally:
+            # Deferred handlers are still running, they are recorded once they are done
+            if not deadline.deferred:
+                self.stats.record(component.name, time.perf_counter() - started_at, command=False)
 
     async def execute_command(self, command, payload, remaining_options):
-        await self.redis.hincrby("cmd:commands", command.full_name, 1)
+        started_at = time.perf_counter()
+        deadline = payload.deadline = InteractionDeadline(
+            command.full_name, payload.id,
+            on_finish=lambda seconds: self.stats.record(command.full_name, seconds)
+        )
+        try:
+            return await self._execute_command(command, payload, remaining_options)
+        finally:
+            if not deadline.deferred:
+                self.stats.record(command.full_name, time.perf_counter() - started_at)
 
-        blacklist = await self.db.blacklist.find_one({"_id": payload.author.id})
-        if blacklist is None and payload.guild_id:
-            blacklist = await self.db.blacklist.find_one({"_id": payload.guild_id})
+    async def _execute_command(self, command, payload, remaining_options):
+        principal = await self.get_principal(payload)
 
+        blacklist = principal["blacklist"]
         if blacklist is not None and command.full_name not in {"opt out", "opt in"}:
             if blacklist.get("guild"):
                 return InteractionResponse.message(**create_message(
@@ -129,15 +357,11 @@ class Xenon(InteractionBot):
                     f=Format.ERROR
                 ), ephemeral=True)
 
-        if payload.entitlement_sku_ids:
+        if payload.entitlement_sku_ids and not principal["entitlement_active"]:
             await self._set_user_entitlement_active(payload.author)
+            principal["entitlement_active"] = True
 
-        premium_level = 0
-        user_doc = await self.db.users.find_one({"_id": payload.author.id})
-        if user_doc is not None:
-            premium_level = user_doc.get("tier", 0)
-
-        payload.premium_level = PremiumLevel(premium_level)
+        payload.premium_level = principal["premium_level"]
         return await super().execute_command(command, payload, remaining_options)
 
     async def get_invite(self):
@@ -172,5 +396,11 @@ class Xenon(InteractionBot):
 
     async def setup(self, redis_url="redis://localhost"):
         self.rpc = RpcCollection()
-        self.mongo = AsyncIOMotorClient(config.MONGO_URL)
+        self.process_pool = ProcessPool(config.PROCESS_POOL_WORKERS, config.PROCESS_POOL_MAX_PENDING)
+        self.mongo = AsyncIOMotorClient(config.MONGO_URL, event_listeners=[MongoCommandMetrics()])
         await super().setup(redis_url)
+        await self._load_blacklist()
+        self.loop.create_task(self._listen(BLACKLIST_CHANNEL, self._on_blacklist_change, self._load_blacklist))
+        self.loop.create_task(self._listen(PREMIUM_CHANNEL, self._on_premium_change, self._clear_premium_levels))
+        self.loop.create_task(self._flush_stats())
+        self.loop.create_task(self._monitor())
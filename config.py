@@ -7,8 +7,25 @@ BETA_GUILD_ID = GUILD_ID or env.get("BETA_GUILD_ID")
 MONGO_URL = env.get("MONGO_URL", "mongodb://localhost")
 REDIS_URL = env.get("REDIS_URL", "redis://localhost")
 
-BACKUPS_SERVICES = env.get("BACKUPS_SERVICE", "127.0.0.1:8081")
-MUTATIONS_SERVICE = env.get("MUTATIONS_SERVICE", "127.0.0.1:8082")
+# Comma separated lists of endpoints
+BACKUPS_SERVICES = env.get("BACKUPS_SERVICE", "127.0.0.1:8081").split(",")
+MUTATIONS_SERVICES = env.get("MUTATIONS_SERVICE", "127.0.0.1:8082").split(",")
+RPC_CHANNELS_PER_ENDPOINT = int(env.get("RPC_CHANNELS_PER_ENDPOINT", 2))
+# least_outstanding or round_robin
+RPC_BALANCING = env.get("RPC_BALANCING", "least_outstanding")
+
+BACKUP_CODEC = env.get("BACKUP_CODEC", "zstd")
+BACKUP_CACHE_SIZE = int(env.get("BACKUP_CACHE_SIZE", 128 * 1024 * 1024))
+# The backup service needs read access to the backups and backup_blobs collections
+BACKUP_LOAD_BY_REFERENCE = bool(env.get("BACKUP_LOAD_BY_REFERENCE", False))
+# Store the previous interval backup as a delta against the newest one, on top of the chunk deduplication
+BACKUP_INTERVAL_DELTAS = bool(env.get("BACKUP_INTERVAL_DELTAS", False))
+
+# Seconds that per minute command stats are kept in redis for
+STATS_WINDOW = int(env.get("STATS_WINDOW", 7 * 24 * 60 * 60))
+
+PROCESS_POOL_WORKERS = int(env.get("PROCESS_POOL_WORKERS", 4))
+PROCESS_POOL_MAX_PENDING = int(env.get("PROCESS_POOL_MAX_PENDING", PROCESS_POOL_WORKERS * 2))
 
 _host = env.get("HOST", "127.0.0.1:8080").split(":")
 
@@ -0,0 +1,212 @@
+import time
+from collections import defaultdict, Counter
+
+__all__ = (
+    "Metrics",
+    "Histogram",
+    "CommandStats",
+    "metrics",
+    "DEFAULT_BUCKETS",
+    "SIZE_BUCKETS",
+)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = tuple(2 ** i * 1024 * 1024 for i in range(10))
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                break
+
+
+class Metrics:
+    """
+    Process local registry of counters, gauges and histograms
+
+    Metrics are identified by their name and labels.
+    """
+
+    def __init__(self):
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.gauge_funcs = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        self.counters[self._key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def gauge(self, name, func, **labels):
+        """
+        Register a function that is called to get the current value of a gauge
+        """
+        self.gauge_funcs[self._key(name, labels)] = func
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+
+        histogram.observe(value)
+
+    def _gauge_values(self):
+        values = dict(self.gauges)
+        for key, func in self.gauge_funcs.items():
+            try:
+                values[key] = func()
+            except Exception:
+                continue
+
+        return values
+
+    def render(self):
+        """
+        Render all metrics in the Prometheus text format
+        """
+        lines = []
+
+        def _group(kind, items):
+            last_name = None
+            for (name, labels), value in sorted(items, key=lambda item: item[0]):
+                if name != last_name:
+                    lines.append(f"# TYPE {name} {kind}")
+                    last_name = name
+
+                yield name, labels, value
+
+        for name, labels, value in _group("counter", self.counters.items()):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name, labels, value in _group("gauge", self._gauge_values().items()):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name, labels, histogram in _group("histogram", self.histograms.items()):
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bucket),))} {cumulative}")
+
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        Get all metrics as a json serializable dict
+        """
+
+        def _name(key):
+            name, labels = key
+            return name + _format_labels(labels)
+
+        return {
+            "counters": {_name(key): value for key, value in self.counters.items()},
+            "gauges": {_name(key): value for key, value in self._gauge_values().items()},
+            "histograms": {
+                _name(key): {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "buckets": dict(zip(map(str, histogram.buckets), histogram.counts))
+                }
+                for key, histogram in self.histograms.items()
+            }
+        }
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+class CommandStats:
+    """
+    Buffers invocations, errors and latencies of commands and components until they are flushed to redis
+
+    Every flush adds the buffered values to the all-time command counters (cmd:commands) and to a hash per minute
+    (cmd:stats:<minute timestamp>) that expires after the configured window. Latencies are stored as the number of
+    invocations per bucket (<name>:bucket:<upper bound>), invocations slower than the last bucket are counted in
+    <name>:bucket:inf.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._reset()
+
+    def _reset(self):
+        self.invocations = Counter()
+        self.errors = Counter()
+        self.latencies = defaultdict(lambda: Histogram(self.buckets))
+
+    def record(self, name, seconds, command=True):
+        self.invocations[(name, command)] += 1
+        self.latencies[name].observe(seconds)
+        metrics.observe("command_seconds", seconds, command=name)
+
+    def record_error(self, name):
+        self.errors[name] += 1
+        metrics.inc("command_errors_total", command=name)
+
+    async def flush(self, redis, window):
+        invocations, errors, latencies = self.invocations, self.errors, self.latencies
+        if not invocations and not errors:
+            return
+
+        self._reset()
+        key = f"cmd:stats:{int(time.time() // 60 * 60)}"
+        # The values are written in a transaction so a failed flush can be retried without counting them twice
+        tr = redis.multi_exec()
+        for (name, command), count in invocations.items():
+            if command:
+                tr.hincrby("cmd:commands", name, count)
+
+            tr.hincrby(key, f"{name}:count", count)
+
+        for name, count in errors.items():
+            tr.hincrby(key, f"{name}:errors", count)
+
+        for name, histogram in latencies.items():
+            tr.hincrbyfloat(key, f"{name}:sum", histogram.sum)
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                if count:
+                    tr.hincrby(key, f"{name}:bucket:{bucket}", count)
+
+            overflow = histogram.count - sum(histogram.counts)
+            if overflow:
+                tr.hincrby(key, f"{name}:bucket:inf", overflow)
+
+        tr.expire(key, window)
+        try:
+            await tr.execute()
+        except Exception:
+            # Keep the counts for the next flush, the latencies are not important enough to merge them back
+            self.invocations.update(invocations)
+            self.errors.update(errors)
+            raise
+
+
+metrics = Metrics()
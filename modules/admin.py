@@ -224,6 +224,7 @@ class AdminModule(Module):
             "staff": ctx.author.id,
             "reason": reason
         }, upsert=True)
+        await ctx.bot.publish_blacklist_change("add", user)
         await ctx.respond(**create_message(
             f"Successfully **added <@{user}> to the blacklist**.",
             f=Format.SUCCESS
@@ -242,6 +243,7 @@ class AdminModule(Module):
             "staff": ctx.author.id,
             "reason": reason
         }, upsert=True)
+        await ctx.bot.publish_blacklist_change("add", server_id)
         await ctx.respond(**create_message(
             f"Successfully **added the server with the id `{server_id}` to the blacklist**.",
             f=Format.SUCCESS
@@ -261,6 +263,7 @@ class AdminModule(Module):
         Remove a user from the blacklist
         """
         await ctx.bot.db.blacklist.delete_one({"_id": user})
+        await ctx.bot.publish_blacklist_change("remove", user)
         await ctx.respond(**create_message(
             f"Successfully **removed <@{user}> from the blacklist**.",
             f=Format.SUCCESS
@@ -273,6 +276,7 @@ class AdminModule(Module):
         Remove a server from the blacklist
         """
         await ctx.bot.db.blacklist.delete_one({"_id": server_id, "guild": True})
+        await ctx.bot.publish_blacklist_change("remove", server_id)
         await ctx.respond(**create_message(
             f"Successfully **added the server with the id `{server_id}` to the blacklist**.",
             f=Format.SUCCESS
@@ -4,6 +4,8 @@ from dbots.cmd import *
 from dbots import *
 from datetime import datetime, timedelta
 
+from util import auto_defer
+
 
 class AuditLogType(IntEnum):
     BACKUP_CREATE = 0
@@ -148,6 +150,7 @@ class AuditLogModule(Module):
     ))
     @checks.has_permissions_level()
     @checks.cooldown(2, 10, bucket=checks.CooldownType.GUILD)
+    @auto_defer(ephemeral=True)
     async def logs(self, ctx, page: int = 1):
         """
         Get a list of actions that were recently taken on this server
@@ -156,11 +159,13 @@ class AuditLogModule(Module):
         await ctx.respond(**data)
 
     @Module.component(name="audit_logs")
+    @auto_defer()
     async def logs_page(self, ctx, page, filter_value):
         data = await self._audit_logs_message(ctx.guild_id, int(page), _deserialize_type_filter(filter_value))
         await ctx.update(**data)
 
     @Module.component(name="audit_logs_filter")
+    @auto_defer()
     async def logs_filter(self, ctx):
         visible_types = [AuditLogType(int(t)) for t in ctx.values]
         data = await self._audit_logs_message(ctx.guild_id, 1, visible_types)
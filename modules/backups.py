@@ -1,5 +1,9 @@
 import asyncio
 import json
+import sys
+import time
+import traceback
+from collections import Counter
 from copy import deepcopy
 from datetime import datetime, timedelta
 
@@ -14,11 +18,59 @@ from xenon.backups import backup_pb2
 
 from dbots import *
 from dbots.cmd import *
-from util import can_upsell, PremiumLevel
+import config
+from metrics import metrics, SIZE_BUCKETS
+from planner import *
+from storage import *
+from util import can_upsell, PremiumLevel, LRUCache, AdaptiveLimiter, auto_defer
 from . import premium
 from .audit_logs import AuditLogType
 
 MAX_BACKUPS = 15
+BACKUP_VERSION = 3
+BACKUPS_PER_PAGE = 10
+EPOCH = datetime(1970, 1, 1)
+# Cached backup counts are recounted after this to correct drift (e.g. from interrupted deletes)
+BACKUP_COUNT_MAX_AGE = timedelta(hours=1)
+PURGE_BATCH_SIZE = 500
+PURGE_CONCURRENCY = 4
+# Backups claimed by a purge batch that didn't finish (e.g. because the worker crashed) can be claimed again after this
+PURGE_CLAIM_TIMEOUT = timedelta(minutes=10)
+# Maximum number of expired backups that are deleted per run of the expiry task
+EXPIRY_LIMIT = 5000
+# GridFS files younger than this are never considered orphaned, they might still be uploading
+ORPHAN_MIN_AGE = timedelta(hours=1)
+# Every n-th interval backup is kept as a full snapshot to limit the length of delta chains
+INTERVAL_REBASE_EVERY = 6
+INTERVAL_CONCURRENCY = 5
+INTERVAL_MAX_CONCURRENCY = 50
+# Create calls that take longer than this don't increase the interval concurrency
+INTERVAL_TARGET_LATENCY = 30
+# Status codes that the backup service uses to signal that it's overloaded
+OVERLOAD_CODES = {grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.DEADLINE_EXCEEDED}
+# Minimum time between two progress updates of the same message
+PROGRESS_INTERVAL = 5
+# Seconds that the status of a loading process is cached for
+LOAD_STATUS_TTL = 3
+TRANSLATOR_MAX_IDS = 10000
+# Learned load factors are read from the database again after this many seconds
+LOAD_FACTORS_TTL = 10 * 60
+# Translators that haven't been used for this long are deleted
+TRANSLATOR_MAX_AGE = timedelta(days=180)
+# Chunks that are pinned for a load are kept at least this long, loading processes are cancelled after 24 hours
+LOAD_PIN_TTL = timedelta(hours=25)
+# Newer versions of the backup service can read the chunks of a backup from the database instead of receiving it
+LOAD_BY_REFERENCE = config.BACKUP_LOAD_BY_REFERENCE and \
+                    "reference" in backup_pb2.LoadRequest.DESCRIPTOR.fields_by_name and \
+                    backup_pb2.LoadRequest.DESCRIPTOR.fields_by_name["reference"].message_type is not None and \
+                    "chunks" in backup_pb2.LoadRequest.DESCRIPTOR.fields_by_name["reference"].message_type.fields_by_name
+# Must be longer than an interval backup can take, otherwise another worker might claim the interval again
+INTERVAL_LEASE = timedelta(minutes=30)
+INTERVAL_MAX_RETRIES = 5
+INTERVAL_RETRY_BACKOFF = timedelta(minutes=2)
+DICTIONARY_SAMPLES = 2000
+DICTIONARY_MAX_SAMPLE_SIZE = 64 * 1024
+DICTIONARY_MAX_AGE = timedelta(days=7)
 ALLOWED_OPTIONS = ("delete_roles", "delete_channels", "roles", "channels", "settings")
 ADVERTISE_OPTIONS = ("bans", "members", "messages")
 
@@ -52,6 +104,115 @@ def channel_tree(channels):
     return f"```\n{result}\n```"
 
 
+def encode_cursor(backup):
+    millis = (backup["timestamp"] - EPOCH) // timedelta(milliseconds=1)
+    return f"{millis}:{backup['_id']}"
+
+
+def decode_cursor(cursor):
+    millis, backup_id = cursor.split(":", 1)
+    return EPOCH + timedelta(milliseconds=int(millis)), backup_id
+
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    if minutes == 0:
+        return "< 1 minute"
+
+    return timedelta_to_string(timedelta(minutes=minutes + int(seconds > 0)))
+
+
+def translated_ids(data):
+    # Only roles and channels are created by the backup service and get a new id
+    return [str(role.id) for role in data.roles] + [str(channel.id) for channel in data.channels]
+
+
+async def load_translator(db, target_id, source_id, keys=None):
+    """
+    Get the ids that have been translated by previous loads of source_id into target_id
+
+    If keys is given, only those ids are read, this keeps the read independent of the number of ids that have been
+    translated in the past.
+    """
+    if keys is None:
+        projection = {"ids": True}
+    elif len(keys) == 0:
+        return {}
+    else:
+        projection = {f"ids.{key}": True for key in keys}
+
+    translator = await db.id_translators.find_one({"target_id": target_id, "source_id": source_id}, projection)
+    if translator is None:
+        return {}
+
+    return translator.get("ids", {})
+
+
+async def save_translator(db, target_id, source_id, ids, known, loader):
+    """
+    Save the ids that have been translated by a load
+
+    known are the ids that have been passed to the load, they are used to keep track of the size of the translator.
+    Translators that grow beyond TRANSLATOR_MAX_IDS only keep the ids of the latest load.
+    """
+    added = sum(1 for s in ids if s not in known)
+    # Translators that have been saved before their size was tracked are counted once
+    await db.id_translators.update_one(
+        {"target_id": target_id, "source_id": source_id, "size": {"$exists": False}},
+        [{"$set": {"size": {"$size": {"$objectToArray": {"$ifNull": ["$ids", {}]}}}}}]
+    )
+    translator = await db.id_translators.find_one_and_update(
+        {"target_id": target_id, "source_id": source_id},
+        {
+            "$set": {
+                "target_id": target_id,
+                "source_id": source_id,
+                "updated": datetime.utcnow(),
+                **{
+                    f"ids.{s}": t
+                    for s, t in ids.items()
+                }
+            },
+            "$inc": {"size": added},
+            "$addToSet": {
+                "loaders": loader
+            }
+        },
+        projection=("size",),
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+    if translator["size"] > TRANSLATOR_MAX_IDS:
+        metrics.inc("id_translator_resets_total")
+        await db.id_translators.update_one(
+            {"_id": translator["_id"]},
+            {"$set": {"ids": dict(ids), "size": len(ids)}}
+        )
+
+
+def create_summary(data):
+    channel_list = channel_tree(data.channels)
+    if len(channel_list) > 1024:
+        channel_list = channel_list[:1000] + "\n...\n```"
+
+    role_list = "```{}```".format("\n".join(
+        [r.name for r in sorted(data.roles, key=lambda r: r.position, reverse=True)]
+    ))
+    if len(role_list) > 1024:
+        role_list = role_list[:1000] + "\n...\n```"
+
+    return {
+        "channel_count": len(data.channels),
+        "role_count": len(data.roles),
+        "member_count": len(data.members),
+        "ban_count": len(data.bans),
+        "channel_tree": channel_list,
+        "role_list": role_list,
+        # members should only be empty for non-premium backups
+        "has_members": len(data.members) > 0
+    }
+
+
 option_descriptions = dict(
     delete_roles="All **existing roles** will be **deleted**",
     delete_channels="All **existing channels** will be **deleted**",
@@ -102,6 +263,169 @@ def option_status_list(options):
     return "\n".join(result)
 
 
+def load_progress_message(reply, name):
+    # Only newer versions of the backup service send the option status with every reply
+    if "options" not in reply.DESCRIPTOR.fields_by_name or len(reply.options) == 0:
+        return None
+
+    return create_message(
+        f"**The {name} is loading**. Please be patient, this can take a while!\n\n"
+        f"Use `/{name} cancel` to cancel the process.\n\n"
+        f"{option_status_list(reply.options)}",
+        f=Format.PLEASE_WAIT
+    )
+
+
+async def last_reply(call, progress=None):
+    """
+    Consume a streaming RPC call and return the last reply
+
+    Earlier replies are passed to progress (if any) and dropped instead of being kept until the call is done.
+    """
+    reply = None
+    try:
+        async for reply in call:
+            if progress is not None:
+                progress(reply)
+    finally:
+        if progress is not None:
+            progress.close()
+
+    return reply
+
+
+class ProgressUpdater:
+    """
+    Edits an interaction response with the progress of a streaming RPC call
+
+    At most one edit is made every interval seconds, replies that arrive in the meantime replace the pending one.
+    render is called with a reply and returns the message or None to skip the reply.
+    """
+
+    def __init__(self, edit, render, interval=PROGRESS_INTERVAL):
+        self.edit = edit
+        self.render = render
+        self.interval = interval
+        self._reply = None
+        self._task = None
+        self._updated_at = time.monotonic()
+
+    def __call__(self, reply):
+        self._reply = reply
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._update())
+
+    async def _update(self):
+        delay = self._updated_at + self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        reply, self._reply = self._reply, None
+        message = self.render(reply)
+        if message is None:
+            return
+
+        self._updated_at = time.monotonic()
+        try:
+            await self.edit(**message)
+        except rest.HTTPException:
+            pass
+
+    def close(self):
+        # The final message must not be overwritten by a pending update
+        if self._task is not None:
+            self._task.cancel()
+
+
+def _format_load_status(reply):
+    estimated_time_left = sum([
+        o.estimated_time_left
+        for o in reply.options.values()
+        if o.state != backup_pb2.LoadStatus.State.STATE_WAITING
+    ])
+
+    etl = format_eta(estimated_time_left)
+
+    details = "\n\n" + "\n".join([f"```{o.details}```" for o in reply.options.values() if o.details])
+    for o in reply.options.values():
+        if o.state == backup_pb2.LoadStatus.State.STATE_RATE_LIMIT:
+            details += f"\n```A long lasting ratelimit has been hit, " \
+                       f"you might want to cancel the loading process.```"
+            break
+
+    return {"etl": etl, "options": option_status_list(reply.options), "details": details}
+
+
+async def _fetch_load_status(bot, guild_id):
+    key = f"load_status:{guild_id}"
+    # Only one worker requests the status, the others wait for it to show up in the cache
+    if not await bot.redis.set(f"{key}:lock", "1", expire=LOAD_STATUS_TTL, exist="SET_IF_NOT_EXIST"):
+        for _ in range(LOAD_STATUS_TTL * 10):
+            cached = await bot.redis.get(key)
+            if cached is not None:
+                metrics.inc("load_status_total", source="cache")
+                return cached
+
+            await asyncio.sleep(0.1)
+
+    try:
+        reply = await bot.rpc.backups.LoadStatus(backup_pb2.LoadStatusRequest(guild_id=guild_id))
+        status = _format_load_status(reply)
+    except AioRpcError as e:
+        if e.code() == grpc.StatusCode.NOT_FOUND:
+            status = None
+        else:
+            raise
+
+    metrics.inc("load_status_total", source="rpc")
+    raw = json.dumps(status).encode()
+    await bot.redis.setex(key, LOAD_STATUS_TTL, raw)
+    return raw
+
+
+async def get_load_status(bot, guild_id, flights):
+    """
+    Get the formatted status of the loading process on a guild as json
+
+    Concurrent lookups for the same guild share a single LoadStatus call through the pending lookups in flights. The
+    result is cached in redis for LOAD_STATUS_TTL seconds so it's shared with the other workers too. Returns None if
+    there is no loading process.
+    """
+    raw = await bot.redis.get(f"load_status:{guild_id}")
+    if raw is not None:
+        metrics.inc("load_status_total", source="cache")
+    else:
+        flight = flights.get(guild_id)
+        if flight is None:
+            flight = flights[guild_id] = asyncio.ensure_future(_fetch_load_status(bot, guild_id))
+            flight.add_done_callback(lambda _: flights.pop(guild_id, None))
+
+        raw = await asyncio.shield(flight)
+
+    if raw == b"null":
+        return None
+
+    return raw
+
+
+def load_status_message(raw, name, cache):
+    # The message is only built again when the status has changed
+    message = cache.get((raw, name))
+    if message is None:
+        status = json.loads(raw)
+        message = create_message(
+            f"Estimated time required for this step: `{status['etl']}`\n\n"
+            f"Type `/{name} cancel` to cancel the loading process.\n\n"
+            f"{status['options']}"
+            f"{status['details']}",
+            title="Loading Status",
+            f=Format.INFO
+        )
+        cache.set((raw, name), message)
+
+    return deepcopy(message)
+
+
 def convert_v1_to_v2(data):
     channels = []
     for channel in data["channels"]:
@@ -196,7 +520,13 @@ def parse_options(default, allowed, option_string):
     return options
 
 
-def create_warning_message(options, redis_key, prefix="backup_", advanced_options=False):
+def create_warning_message(options, redis_key, prefix="backup_", advanced_options=False, plan=None):
+    eta = ""
+    if plan is not None:
+        eta = f"\n\nEstimated time required: `{format_eta(plan['seconds'])}`"
+        if plan["blocked"]:
+            eta += "\n*This includes waiting for a Discord rate limit to reset.*"
+
     other_buttons = []
     if advanced_options:
         other_buttons.append(
@@ -207,7 +537,7 @@ def create_warning_message(options, redis_key, prefix="backup_", advanced_option
     return dict(
         **create_message(
             "**Hey, be careful!** The following actions will be taken on this server and **can not be undone**:\n\n"
-            f"{option_list(options)}",
+            f"{option_list(options)}{eta}",
             f=Format.WARNING
         ),
         components=[
@@ -272,18 +602,64 @@ class BackupsModule(Module):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.grid_fs = None
+        self.dict_id = None
+        self.decoding_bytes = 0
+        metrics.gauge("backup_decoding_bytes", lambda: self.decoding_bytes)
+        # Decoded backups are shared between callers and must not be modified
+        self.backup_cache = LRUCache("backups", config.BACKUP_CACHE_SIZE, size=lambda data: data.ByteSize())
+        self.load_factors = LRUCache("load_factors", 1, ttl=LOAD_FACTORS_TTL)
+        self.status_flights = {}
+        self.status_messages = LRUCache("backup_status_messages", 256)
+        self.interval_owner = unique_id()
+        self.interval_limiter = AdaptiveLimiter(
+            "intervals", INTERVAL_CONCURRENCY,
+            max_limit=INTERVAL_MAX_CONCURRENCY,
+            target_latency=INTERVAL_TARGET_LATENCY
+        )
+        self.interval_tasks = set()
+        self.interval_claiming = False
+        # Running migrations by backup id
+        self.migrations = {}
 
     async def post_setup(self):
         self.grid_fs = AsyncIOMotorGridFSBucket(self.bot.db, "backup_chunks", chunk_size_bytes=8000000)
         await self.bot.db.backups.create_index([("creator", pymongo.ASCENDING)])
+        await self.bot.db.backups.create_index([
+            ("creator", pymongo.ASCENDING),
+            ("timestamp", pymongo.DESCENDING),
+            ("_id", pymongo.DESCENDING)
+        ])
         await self.bot.db.backups.create_index([("timestamp", pymongo.ASCENDING)])
+        # Backups that never expire store None, they don't need to be in the index
+        await self.bot.db.backups.create_index(
+            [("expires_at", pymongo.ASCENDING)],
+            partialFilterExpression={"expires_at": {"$type": "date"}}
+        )
         await self.bot.db.backups.create_index([("data.id", pymongo.ASCENDING)])
+        await self.bot.db.backups.create_index([("delta.base", pymongo.ASCENDING)], sparse=True)
+        await self.bot.db.backups.create_index(
+            [("data.raw", pymongo.ASCENDING)],
+            partialFilterExpression={"large": True}
+        )
+        await self.bot.db.backup_pins.create_index([("chunks", pymongo.ASCENDING)])
+        await self.bot.db.backup_pins.create_index([("expires_at", pymongo.ASCENDING)])
         await self.bot.db.intervals.create_index([("guild", pymongo.ASCENDING), ("user", pymongo.ASCENDING)])
         await self.bot.db.intervals.create_index([("next", pymongo.ASCENDING)])
         await self.bot.db.id_translators.create_index(
             [("source_id", pymongo.ASCENDING), ("target_id", pymongo.ASCENDING)],
             unique=True
         )
+        await self.bot.db.id_translators.create_index(
+            [("updated", pymongo.ASCENDING)],
+            expireAfterSeconds=int(TRANSLATOR_MAX_AGE.total_seconds())
+        )
+        # Translators that have been saved before they had an update time would never expire
+        if await self.bot.redis.set("backups:translators_updated", "1", exist="SET_IF_NOT_EXIST"):
+            await self.bot.db.id_translators.update_many(
+                {"updated": {"$exists": False}},
+                {"$set": {"updated": datetime.utcnow()}}
+            )
+        await self._refresh_dictionary()
 
     async def _unknown_backup_message(self, user_id, backup_id):
         data = deepcopy(create_message(
@@ -337,7 +713,7 @@ class BackupsModule(Module):
 
         Get more help on the [wiki](https://wiki.xenon.bot/backups#creating-a-backup).
         """
-        backup_count = await ctx.bot.db.backups.count_documents({"creator": ctx.author.id})
+        backup_count = await self._backup_count(ctx.author.id)
         if backup_count > MAX_BACKUPS:
             await ctx.respond(**create_message(
                 f"You have **exceeded the maximum count** of backups. (`{backup_count}/{MAX_BACKUPS}`)\n"
@@ -355,11 +731,11 @@ class BackupsModule(Module):
         ), ephemeral=True)
 
         try:
-            replies = [resp async for resp in self.bot.rpc.backups.Create(backup_pb2.CreateRequest(
+            reply = await last_reply(self.bot.rpc.backups.Create(backup_pb2.CreateRequest(
                 guild_id=ctx.guild_id,
                 options=["roles", "channels", "settings"],
                 message_count=0
-            ))]
+            )))
         except AioRpcError as e:
             if e.code() == grpc.StatusCode.NOT_FOUND:
                 await ctx.edit_response(**create_message(
@@ -371,7 +747,7 @@ class BackupsModule(Module):
             else:
                 raise
 
-        data = replies[-1].data
+        data = reply.data
         expires = not ctx.entitlement_sku_ids and ctx.premium_level == PremiumLevel.NONE
         backup_id = await self._store_backup(ctx.author.id, data, expires=expires)
 
@@ -407,16 +783,39 @@ class BackupsModule(Module):
         )
 
         redis_key = f"backup_load:{unique_id()}"
-        await ctx.bot.redis.setex(redis_key, 60 * 5, json.dumps({
+        scope = {
             "backup_id": backup_id,
             "form_id": secure_id(),
             "options": list(parsed_options)
-        }))
+        }
+        await ctx.bot.redis.setex(redis_key, 60 * 5, json.dumps(scope))
+
         if edit:
             await ctx.edit_response(**create_warning_message(parsed_options, redis_key))
         else:
             await ctx.respond(**create_warning_message(parsed_options, redis_key), ephemeral=True)
 
+        # Counting the roles and channels of the guild takes two API calls, the estimate is added after responding.
+        # The counts are stored under their own key so options that are selected in the meantime are not overwritten.
+        counts = await self._load_counts(ctx, backup_id)
+        if counts is None:
+            return
+
+        await ctx.bot.redis.setex(f"{redis_key}:counts", 60 * 11, json.dumps(counts))
+        scope = await ctx.bot.redis.get(redis_key)
+        if scope is None:
+            return
+
+        # The options might have been changed in the meantime, the message shows them already
+        if json.loads(scope)["options"] != list(parsed_options):
+            return
+
+        plan = await self._plan_load(ctx, redis_key, list(parsed_options))
+        try:
+            await ctx.edit_response(**create_warning_message(parsed_options, redis_key, plan=plan))
+        except rest.HTTPException:
+            pass
+
     async def _backup_id_autocomplete(self, ctx, backup_id):
         redis_key = f"autocomplete:backups:{ctx.author.id}"
 
@@ -461,6 +860,7 @@ class BackupsModule(Module):
     @checks.bot_has_permissions("administrator")
     @checks.not_in_maintenance
     @checks.cooldown(1, 5 * 60, bucket=checks.CooldownType.GUILD, manual=True)
+    @auto_defer(ephemeral=True)
     async def load(self, ctx, backup_id: str.strip, options: str.lower = ""):
         """
         Load a previously created backup on this server
@@ -473,10 +873,12 @@ class BackupsModule(Module):
     @checks.has_permissions_level(destructive=True)
     @checks.bot_has_permissions("administrator")
     @checks.not_in_maintenance
+    @auto_defer()
     async def load_direct(self, ctx, backup_id):
         return await self._backup_load(ctx, backup_id, "", edit=True)
 
     @Module.component(name="backup_load_options")
+    @auto_defer()
     async def load_options(self, ctx, redis_key):
         scope = await ctx.bot.redis.get(redis_key)
         if scope is None:
@@ -501,7 +903,8 @@ class BackupsModule(Module):
                 return
 
         await ctx.bot.redis.setex(redis_key, 60 * 5, json.dumps(scope))
-        await ctx.update(**create_warning_message(scope["options"], redis_key))
+        plan = await self._plan_load(ctx, redis_key, scope["options"])
+        await ctx.update(**create_warning_message(scope["options"], redis_key, plan=plan))
 
     async def _get_load_advanced_meta(self, ctx, backup_id):
         guild_roles = await ctx.fetch_guild_roles()
@@ -558,6 +961,7 @@ class BackupsModule(Module):
         }
 
     @Module.component(name="backup_load_advanced")
+    @auto_defer()
     async def load_advanced(self, ctx, redis_key):
         scope = await ctx.bot.redis.get(redis_key)
         if scope is None:
@@ -580,6 +984,7 @@ class BackupsModule(Module):
         await ctx.update(**create_advanced_options_message(form_id, redis_key))
 
     @Module.component(name="backup_load_advanced_done")
+    @auto_defer()
     async def load_advanced_done(self, ctx, redis_key):
         scope = await ctx.bot.redis.get(redis_key)
         if scope is None:
@@ -592,14 +997,15 @@ class BackupsModule(Module):
         scope = json.loads(scope)
 
         await ctx.bot.redis.setex(redis_key, 60 * 5, json.dumps(scope))
-        await ctx.update(**create_warning_message(scope["options"], redis_key))
+        plan = await self._plan_load(ctx, redis_key, scope["options"])
+        await ctx.update(**create_warning_message(scope["options"], redis_key, plan=plan))
 
     @Module.component(name="backup_load_cancel")
     async def load_cancel(self, ctx, redis_key):
         scope = await ctx.bot.redis.get(redis_key)
         if scope is not None:
             scope = json.loads(scope)
-            await ctx.bot.redis.delete(redis_key, f"forms:{scope['form_id']}")
+            await ctx.bot.redis.delete(redis_key, f"{redis_key}:counts", f"forms:{scope['form_id']}")
 
         await ctx.update(**create_message(
             "The loading process has been **cancelled**.\n\n"
@@ -608,6 +1014,7 @@ class BackupsModule(Module):
         ), ephemeral=True)
 
     @Module.component(name="backup_load_confirm")
+    @auto_defer()
     async def load_confirm(self, ctx, redis_key):
         scope = await ctx.bot.redis.get(redis_key)
         if scope is None:
@@ -628,17 +1035,35 @@ class BackupsModule(Module):
 
         await ctx.bot.redis.delete(redis_key, f"forms:{form_id}")
 
-        props, data = await self._retrieve_backup(ctx.author.id, backup_id)
-        if data is None:
-            await ctx.update(**create_message(
-                "Something went wrong, try again with `/backup load`",
-                f=Format.ERROR
-            ))
-            return
+        reference = None
+        if LOAD_BY_REFERENCE:
+            reference = await self._backup_reference(ctx.author.id, backup_id)
 
+        if reference is not None:
+            # The backup service reads the chunks from the database itself. The chunk list is sent instead of the
+            # backup id because the backup can be converted to a delta or deleted while it's loading.
+            source_id = reference["data"]["id"]
+            role_count = reference["data"]["summary"]["role_count"]
+            payload = dict(reference=dict(chunks=reference["data"]["chunks"]))
+        else:
+            props, data = await self._retrieve_backup(ctx.author.id, backup_id)
+            if data is None:
+                await ctx.update(**create_message(
+                    "Something went wrong, try again with `/backup load`",
+                    f=Format.ERROR
+                ))
+                return
+
+            source_id = data.id
+            role_count = len(data.roles)
+            payload = dict(data=data)
+
+        metrics.inc("backup_loads_total", mode="reference" if reference is not None else "data")
+        plan = await self._plan_load(ctx, redis_key, options, role_count=role_count)
+        await ctx.bot.redis.delete(f"{redis_key}:counts")
         role_route = rest.Route("POST", "/guilds/{guild_id}/roles", guild_id=ctx.guild_id)
         bucket = await ctx.bot.http.get_ratelimit_bucket(role_route)
-        if bucket is not None and bucket["remaining"] < len(data.roles) and "roles" in options:
+        if bucket is not None and bucket["remaining"] < role_count and "roles" in options:
             await ctx.update(**create_message(
                 f"Due to a **Discord limitation** the bot is **not able to load this backup** at the moment.\n\n"
                 f"You have to wait **{timedelta_to_string(timedelta(seconds=bucket['time_remaining']))}** "
@@ -660,13 +1085,10 @@ class BackupsModule(Module):
             "extra": {}
         })
 
-        ids = {}
-        translator = await ctx.bot.db.id_translators.find_one({
-            "target_id": ctx.guild_id,
-            "source_id": data.id
-        })
-        if translator is not None:
-            ids = translator.get("ids", {})
+        ids = await load_translator(
+            ctx.bot.db, ctx.guild_id, source_id,
+            keys=translated_ids(data) if reference is None else reference["data"]["translated_ids"]
+        )
 
         await ctx.update(**create_message(
             "**The backup will start loading now**. Please be patient, this can take a while!\n\n"
@@ -675,17 +1097,33 @@ class BackupsModule(Module):
             f=Format.INFO
         ))
 
+        pin_id = None
+        if reference is not None:
+            pin_id = await self._pin_chunks(reference["data"]["chunks"])
+            if pin_id is None:
+                # The chunks have been released since the lookup, the backup has changed and is sent instead
+                _, data = await self._retrieve_backup(ctx.author.id, backup_id)
+                if data is None:
+                    await ctx.update(**create_message(
+                        "Something went wrong, try again with `/backup load`",
+                        f=Format.ERROR
+                    ))
+                    return
+
+                payload = dict(data=data)
+
+        started_at = time.monotonic()
         try:
-            replies = [reply async for reply in self.bot.rpc.backups.Load(backup_pb2.LoadRequest(
+            reply = await last_reply(self.bot.rpc.backups.Load(backup_pb2.LoadRequest(
                 guild_id=ctx.guild_id,
                 options=list(options),
                 message_count=0,
-                data=data,
+                **payload,
                 reason="Backup loaded by " + str(ctx.author),
                 ids=ids,
                 exclude_delete_ids=advanced.get("exclude_delete_ids", []),
                 exclude_load_ids=advanced.get("exclude_load_ids", [])
-            ))]
+            )), progress=ProgressUpdater(ctx.update, lambda r: load_progress_message(r, "backup")))
         except AioRpcError as e:
             if e.code() == grpc.StatusCode.ALREADY_EXISTS:
                 await ctx.update(**create_message(
@@ -722,6 +1160,12 @@ class BackupsModule(Module):
                 return
             else:
                 raise
+        finally:
+            if pin_id is not None:
+                await self._unpin_chunks(pin_id)
+
+        if plan is not None:
+            await self._record_load(plan, time.monotonic() - started_at)
 
         try:
             await ctx.update(**create_message(
@@ -732,32 +1176,14 @@ class BackupsModule(Module):
             pass
 
         # Save ids for later use and recovery
-        if len(replies[-1].ids) > 0:
-            await ctx.bot.db.id_translators.update_one(
-                {
-                    "target_id": ctx.guild_id,
-                    "source_id": data.id,
-                },
-                {
-                    "$set": {
-                        "target_id": ctx.guild_id,
-                        "source_id": data.id,
-                        **{
-                            f"ids.{s}": t
-                            for s, t in replies[-1].ids.items()
-                        }
-                    },
-                    "$addToSet": {
-                        "loaders": ctx.author.id
-                    }
-                },
-                upsert=True
-            )
+        if len(reply.ids) > 0:
+            await save_translator(ctx.bot.db, ctx.guild_id, source_id, reply.ids, ids, ctx.author.id)
 
     @backup.sub_command()
     @checks.guild_only
     @checks.has_permissions_level(destructive=True)
     @checks.cooldown(2, 30, bucket=checks.CooldownType.GUILD)
+    @auto_defer(ephemeral=True)
     async def cancel(self, ctx):
         """
         Cancel the currently running loading process on this server
@@ -783,65 +1209,38 @@ class BackupsModule(Module):
     @checks.guild_only
     @checks.has_permissions_level()
     @checks.cooldown(2, 10, bucket=checks.CooldownType.GUILD)
+    @auto_defer(ephemeral=True)
     async def status(self, ctx):
         """
         Get the status of the currently running loading process
         """
-        try:
-            reply = await self.bot.rpc.backups.LoadStatus(backup_pb2.LoadStatusRequest(guild_id=ctx.guild_id))
-        except AioRpcError as e:
-            if e.code() == grpc.StatusCode.NOT_FOUND:
-                await ctx.respond(**create_message(
-                    "There is **no loading process running** on this server.",
-                    f=Format.ERROR
-                ), ephemeral=True)
-                return
-            else:
-                raise
-
-        estimated_time_left = sum([
-            o.estimated_time_left
-            for o in reply.options.values()
-            if o.state != backup_pb2.LoadStatus.State.STATE_WAITING
-        ])
-
-        minutes = estimated_time_left // 60
-        seconds = estimated_time_left % 60
-        if minutes == 0:
-            etl = "< 1 minute"
-        else:
-            etl = timedelta_to_string(timedelta(minutes=minutes + int(seconds > 0)))
-
-        details = "\n\n" + "\n".join([f"```{o.details}```" for o in reply.options.values() if o.details])
-        for o in reply.options.values():
-            if o.state == backup_pb2.LoadStatus.State.STATE_RATE_LIMIT:
-                details += f"\n```A long lasting ratelimit has been hit, " \
-                           f"you might want to cancel the loading process.```"
-                break
+        status = await get_load_status(self.bot, ctx.guild_id, self.status_flights)
+        if status is None:
+            await ctx.respond(**create_message(
+                "There is **no loading process running** on this server.",
+                f=Format.ERROR
+            ), ephemeral=True)
+            return
 
-        await ctx.respond(**create_message(
-            f"Estimated time required for this step: `{etl}`\n\n"
-            f"Type `/backup cancel` to cancel the loading process.\n\n"
-            f"{option_status_list(reply.options)}"
-            f"{details}",
-            title="Loading Status",
-            f=Format.INFO
-        ), ephemeral=True)
+        await ctx.respond(**load_status_message(status, "backup", self.status_messages), ephemeral=True)
 
     async def _backup_info_message(self, user_id, backup_id, direct_load=True):
-        props, data = await self._retrieve_backup(user_id, backup_id)
-        if data is None:
+        props = await self.bot.db.backups.find_one(
+            {"_id": backup_id.lower(), "creator": user_id},
+            projection=("timestamp", "expires_at", "interval", "large", "data.name", "data.summary")
+        )
+        if props is None:
             return None
 
-        channel_list = channel_tree(data.channels)
-        if len(channel_list) > 1024:
-            channel_list = channel_list[:1000] + "\n...\n```"
+        summary = props["data"].get("summary")
+        if summary is None:
+            # Backups created before summaries existed
+            _, data = await self._retrieve_backup(user_id, backup_id)
+            if data is None:
+                return None
 
-        role_list = "```{}```".format("\n".join(
-            [r.name for r in sorted(data.roles, key=lambda r: r.position, reverse=True)]
-        ))
-        if len(role_list) > 1024:
-            role_list = role_list[:1000] + "\n...\n```"
+            summary = create_summary(data)
+            await self.bot.db.backups.update_one({"_id": backup_id.lower()}, {"$set": {"data.summary": summary}})
 
         properties = []
         if props.get("interval"):
@@ -867,8 +1266,7 @@ class BackupsModule(Module):
             ))
 
         description = ""
-        # members should only be empty for non-premium backups
-        if len(data.members) == 0:
+        if not summary["has_members"]:
             description += "This backup doesn't contain any messages, members, or bans! " \
                            "[⭐ Learn More](https://wiki.xenon.bot/en/premium)\n​"
 
@@ -876,7 +1274,7 @@ class BackupsModule(Module):
             "expires_at") is not None else "`forever`"
         return dict(
             embeds=[{
-                "title": f"Backup Info - *{data.name}*",
+                "title": f"Backup Info - *{props['data']['name']}*",
                 "color": Format.INFO.color,
                 "description": description,
                 "footer": {"text": "  ".join(properties)},
@@ -893,12 +1291,12 @@ class BackupsModule(Module):
                     },
                     {
                         "name": "Channels",
-                        "value": channel_list,
+                        "value": summary["channel_tree"],
                         "inline": True
                     },
                     {
                         "name": "Roles",
-                        "value": role_list,
+                        "value": summary["role_list"],
                         "inline": True
                     },
                 ]
@@ -923,6 +1321,7 @@ class BackupsModule(Module):
         )
     ))
     @checks.cooldown(5, 30, bucket=checks.CooldownType.AUTHOR)
+    @auto_defer(ephemeral=True)
     async def info(self, ctx, backup_id: str.strip):
         """
         Get information about a previously created backup
@@ -934,10 +1333,10 @@ class BackupsModule(Module):
         backup_id = ctx.values[0]
         return await self._backup_info(ctx, backup_id)
 
-    async def _backup_list_message(self, user_id, page):
+    async def _backup_list_message(self, user_id, page, cursor=None, direction=None):
         _filter = {"creator": user_id}
         page = max(page, 1)
-        total_count = await self.bot.db.backups.count_documents(_filter)
+        total_count = await self._backup_count(user_id)
         if total_count == 0:
             return dict(
                 **create_message(
@@ -947,15 +1346,42 @@ class BackupsModule(Module):
                 ephemeral=True
             )
 
-        fields = []
-        select_options = []
-        async for backup in self.bot.db.backups.find(
+        sort = [("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+        skip = 0
+        if cursor:
+            # The cursor points at the first or last backup of the page the button was attached to,
+            # this way mongodb can seek to the page using the index instead of skipping over all previous backups
+            timestamp, backup_id = decode_cursor(cursor)
+            op = "$lt" if direction == "after" else "$gt"
+            _filter["$or"] = [
+                {"timestamp": {op: timestamp}},
+                {"timestamp": timestamp, "_id": {op: backup_id}}
+            ]
+            if direction != "after":
+                sort = [("timestamp", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]
+        else:
+            skip = (page - 1) * BACKUPS_PER_PAGE
+
+        backups = [
+            backup
+            async for backup in self.bot.db.backups.find(
                 _filter,
-                sort=[("timestamp", pymongo.DESCENDING)],
-                limit=10,
-                skip=(page - 1) * 10,
+                sort=sort,
+                limit=BACKUPS_PER_PAGE,
+                skip=skip,
                 projection=("_id", "timestamp", "interval", "large", "data.id", "data.name", "data.key")
-        ):
+            )
+        ]
+        if sort[0][1] == pymongo.ASCENDING:
+            backups.reverse()
+
+        if len(backups) == 0 and (page != 1 or cursor):
+            # Backups have been deleted since the page was displayed
+            return await self._backup_list_message(user_id, 1)
+
+        fields = []
+        select_options = []
+        for backup in backups:
             properties = []
             if backup.get("interval"):
                 properties.append("⏲️")
@@ -976,8 +1402,15 @@ class BackupsModule(Module):
                 value=backup_id
             ))
 
-        description = f"Displaying **{(page - 1) * 10 + 1}** - **{min(page * 10, total_count)}** " \
-                      f"of **{total_count}** total backups"
+        first = (page - 1) * BACKUPS_PER_PAGE + 1
+        description = f"Displaying **{min(first, total_count)}** - " \
+                      f"**{min(first + len(backups) - 1, total_count)}** of **{total_count}** total backups"
+
+        previous_args = [str(page - 1)]
+        next_args = [str(page + 1)]
+        if backups:
+            previous_args.extend((encode_cursor(backups[0]), "before"))
+            next_args.extend((encode_cursor(backups[-1]), "after"))
 
         return dict(
             embeds=[dict(
@@ -997,10 +1430,10 @@ class BackupsModule(Module):
                     )
                 ),
                 ActionRow(
-                    Button(label="Previous Page", custom_id=f"backup_list", args=[str(page - 1)],
+                    Button(label="Previous Page", custom_id=f"backup_list", args=previous_args,
                            disabled=page <= 1),
-                    Button(label="Next Page", custom_id=f"backup_list", args=[str(page + 1)],
-                           disabled=total_count <= page * 10)
+                    Button(label="Next Page", custom_id=f"backup_list", args=next_args,
+                           disabled=total_count <= page * BACKUPS_PER_PAGE)
                 )
             ],
             ephemeral=True
@@ -1010,6 +1443,7 @@ class BackupsModule(Module):
         page="The page to display (default 1)"
     ))
     @checks.cooldown(2, 10, bucket=checks.CooldownType.AUTHOR)
+    @auto_defer(ephemeral=True)
     async def list(self, ctx, page: int = 1):
         """
         Get a list of all your previously created backups
@@ -1018,8 +1452,9 @@ class BackupsModule(Module):
         await ctx.respond(**data)
 
     @Module.component(name="backup_list")
-    async def list_page(self, ctx, page):
-        data = await self._backup_list_message(ctx.author.id, int(page))
+    @auto_defer()
+    async def list_page(self, ctx, page, cursor="", direction=""):
+        data = await self._backup_list_message(ctx.author.id, int(page), cursor, direction)
         await ctx.update(**data)
 
     @backup.sub_command(extends=dict(
@@ -1062,6 +1497,7 @@ class BackupsModule(Module):
         )
 
     @Module.component(name="backup_delete_direct_confirm")
+    @auto_defer()
     async def delete_direct_confirm(self, ctx, backup_id):
         result = await self._delete_backup(ctx.author.id, backup_id)
         if result:
@@ -1099,6 +1535,7 @@ class BackupsModule(Module):
         )
     )
     @checks.cooldown(1, 30, bucket=checks.CooldownType.AUTHOR, manual=True)
+    @auto_defer(ephemeral=True)
     async def purge(self, ctx, older_than="", server_name=None):
         """
         Delete all (or some) of your backups >THIS CAN NOT BE UNDONE<
@@ -1115,7 +1552,7 @@ class BackupsModule(Module):
         if server_name:
             _filter["data.name"] = server_name.strip()
 
-        total_count = await self.bot.db.backups.count_documents({"creator": ctx.author.id})
+        total_count = await self._backup_count(ctx.author.id)
         delete_count = await self.bot.db.backups.count_documents(_filter)
 
         if delete_count == 0:
@@ -1140,6 +1577,7 @@ class BackupsModule(Module):
         )], ephemeral=True)
 
     @Module.component(name="backup_purge_confirm")
+    @auto_defer()
     async def purge_confirm(self, ctx, redis_key):
         scope = await ctx.bot.redis.get(redis_key)
         if scope is None:
@@ -1162,12 +1600,23 @@ class BackupsModule(Module):
 
         await self.purge.cooldown.count(ctx)
 
-        total_count = await self.bot.db.backups.count_documents({"creator": ctx.author.id})
-        deleted_count = await self._delete_backups(_filter)
+        total_count = await self._backup_count(ctx.author.id)
         await ctx.update(**create_message(
+            "Deleting backups ...",
+            f=Format.PLEASE_WAIT
+        ), ephemeral=True)
+
+        async def _progress(deleted, total):
+            await ctx.edit_response(**create_message(
+                f"Deleting backups ... (`{deleted}/{total}`)",
+                f=Format.PLEASE_WAIT
+            ))
+
+        deleted_count = await self._delete_backups(_filter, progress=_progress)
+        await ctx.edit_response(**create_message(
             f"Successfully deleted **{deleted_count}** of **{total_count}** total backups.",
             f=Format.SUCCESS
-        ), ephemeral=True)
+        ))
 
     @Module.component(name="backup_purge_cancel")
     async def purge_cancel(self, ctx):
@@ -1189,6 +1638,7 @@ class BackupsModule(Module):
     @checks.guild_only
     @checks.has_permissions_level()
     @checks.cooldown(2, 10, bucket=checks.CooldownType.AUTHOR)
+    @auto_defer(ephemeral=True)
     async def show(self, ctx):
         """
         Show your current backup interval for this server
@@ -1258,6 +1708,7 @@ class BackupsModule(Module):
     @checks.guild_only
     @checks.has_permissions_level()
     @checks.cooldown(1, 10, bucket=checks.CooldownType.AUTHOR)
+    @auto_defer(ephemeral=True)
     async def on(self, ctx, interval):
         """
         Enable your backup interval for this server
@@ -1285,14 +1736,17 @@ class BackupsModule(Module):
         interval_td = timedelta(hours=hours)
 
         now = datetime.utcnow()
-        await ctx.bot.db.intervals.update_one({"guild": ctx.guild_id, "user": ctx.author.id}, {"$set": {
-            "guild": ctx.guild_id,
-            "user": ctx.author.id,
-            "keep": keep,
-            "last": now,
-            "next": now,
-            "interval": hours
-        }}, upsert=True)
+        await ctx.bot.db.intervals.update_one({"guild": ctx.guild_id, "user": ctx.author.id}, {
+            "$set": {
+                "guild": ctx.guild_id,
+                "user": ctx.author.id,
+                "keep": keep,
+                "last": now,
+                "next": now,
+                "interval": hours
+            },
+            "$unset": {"scheduled": ""}
+        }, upsert=True)
 
         next_backup = now + interval_td
         await ctx.respond(**create_message(
@@ -1315,6 +1769,7 @@ class BackupsModule(Module):
     @checks.guild_only
     @checks.has_permissions_level()
     @checks.cooldown(1, 10, bucket=checks.CooldownType.AUTHOR)
+    @auto_defer(ephemeral=True)
     async def off(self, ctx):
         """
         Disable your backup interval for this server
@@ -1343,26 +1798,459 @@ class BackupsModule(Module):
                 f=Format.ERROR
             ), ephemeral=True)
 
+    async def _backup_count(self, creator):
+        doc = await self.bot.db.backup_counts.find_one({"_id": creator})
+        if doc is not None and doc["updated"] > datetime.utcnow() - BACKUP_COUNT_MAX_AGE:
+            return max(doc["count"], 0)
+
+        count = await self.bot.db.backups.count_documents({"creator": creator})
+        await self.bot.db.backup_counts.update_one(
+            {"_id": creator},
+            {"$set": {"count": count, "updated": datetime.utcnow()}},
+            upsert=True
+        )
+        return count
+
+    async def _change_backup_count(self, creator, change):
+        # Missing counters are created by the next _backup_count call
+        await self.bot.db.backup_counts.update_one({"_id": creator}, {"$inc": {"count": change}})
+
+    async def _load_counts(self, ctx, backup_id):
+        doc = await self.bot.db.backups.find_one(
+            {"_id": backup_id.lower(), "creator": ctx.author.id},
+            projection=("data.summary",)
+        )
+        summary = doc["data"].get("summary") if doc is not None else None
+        if summary is None:
+            return None
+
+        return {
+            "backup": {
+                "roles": summary["role_count"],
+                "channels": summary["channel_count"],
+                "members": summary["member_count"],
+                "bans": summary["ban_count"]
+            },
+            "guild": {
+                "roles": len(await ctx.fetch_guild_roles()),
+                "channels": len(await ctx.fetch_guild_channels())
+            }
+        }
+
+    async def _load_factors(self):
+        factors = self.load_factors.get("factors")
+        if factors is None:
+            factors = {
+                (doc["option"], doc["size_class"]): doc["seconds_per_call"]
+                async for doc in self.bot.db.load_stats.find()
+            }
+            self.load_factors.set("factors", factors)
+
+        return factors
+
+    async def _plan_load(self, ctx, redis_key, options, role_count=None):
+        counts = await ctx.bot.redis.get(f"{redis_key}:counts")
+        if counts is None:
+            return None
+
+        counts = json.loads(counts)
+        if role_count is not None:
+            counts["backup"]["roles"] = role_count
+
+        role_route = rest.Route("POST", "/guilds/{guild_id}/roles", guild_id=ctx.guild_id)
+        bucket = await ctx.bot.http.get_ratelimit_bucket(role_route)
+        return plan_load(
+            options, counts["backup"], counts["guild"],
+            factors=await self._load_factors(),
+            buckets={"roles": bucket} if bucket is not None else None
+        )
+
+    async def _record_load(self, plan, seconds):
+        # The duration is split between the options based on their predicted share
+        predicted = sum(step["seconds"] for step in plan["steps"])
+        actual = max(seconds - sum(step["wait"] for step in plan["steps"]), 0)
+        factors = await self._load_factors()
+        for step in plan["steps"]:
+            if step["calls"] == 0:
+                continue
+
+            key = (step["option"], size_class(step["calls"]))
+            factor = factors.get(key, SECONDS_PER_CALL.get(step["option"], 1))
+            await self.bot.db.load_stats.update_one(
+                {"_id": f"{key[0]}:{key[1]}"},
+                {
+                    "$set": {
+                        "option": key[0],
+                        "size_class": key[1],
+                        "seconds_per_call": update_factor(factor, predicted, actual)
+                    },
+                    "$inc": {"loads": 1}
+                },
+                upsert=True
+            )
+
+        metrics.observe("backup_load_seconds", seconds, buckets=(60, 300, 900, 1800, 3600, 3 * 3600, 12 * 3600))
+        metrics.observe("backup_load_prediction_ratio", actual / predicted if predicted > 0 else 1,
+                        buckets=(0.25, 0.5, 0.75, 1, 1.5, 2, 4))
+        self.load_factors.delete("factors")
+
+    async def _backup_reference(self, creator, backup_id):
+        """
+        Get the document of a backup that can be loaded by reference
+
+        Only full chunked backups can be read by the backup service, legacy and delta backups return None. Backups that
+        have been stored before their translated ids were stored with them also return None.
+        The chunks must be pinned with _pin_chunks before they are sent to the backup service.
+        """
+        doc = await self.bot.db.backups.find_one(
+            {"_id": backup_id.lower(), "creator": creator},
+            projection=("delta", "data.id", "data.summary", "data.translated_ids", "data.chunks")
+        )
+        if doc is None or doc.get("delta"):
+            return None
+
+        if any(field not in doc["data"] for field in ("chunks", "summary", "translated_ids")):
+            return None
+
+        return doc
+
+    async def _pin_chunks(self, hashes):
+        """
+        Keep the chunks until they are unpinned with _unpin_chunks, but at most for LOAD_PIN_TTL
+
+        The pin is a lease and not a reference, pins of crashed workers expire and are removed by the expiry task.
+        Returns the id of the pin or None without pinning anything if some of the chunks don't exist anymore.
+        """
+        hashes = list(set(hashes))
+        pin_id = unique_id()
+        await self.bot.db.backup_pins.insert_one({
+            "_id": pin_id,
+            "chunks": hashes,
+            "expires_at": datetime.utcnow() + LOAD_PIN_TTL
+        })
+
+        # The chunks are checked after pinning, chunks that are released from now on are kept
+        existing = await self.bot.db.backup_blobs.count_documents({"_id": {"$in": hashes}, "data": {"$exists": True}})
+        if existing < len(hashes):
+            await self._unpin_chunks(pin_id)
+            return None
+
+        return pin_id
+
+    async def _unpin_chunks(self, pin_id):
+        pin = await self.bot.db.backup_pins.find_one_and_delete({"_id": pin_id})
+        if pin is not None:
+            await self._delete_unreferenced_chunks(pin["chunks"])
+
+    async def _sweep_expired_pins(self):
+        swept = 0
+        async for pin in self.bot.db.backup_pins.find({"expires_at": {"$lt": datetime.utcnow()}}, projection=()):
+            await self._unpin_chunks(pin["_id"])
+            swept += 1
+
+        metrics.inc("backup_expired_pins_total", swept)
+
     async def _backup_exists(self, creator, backup_id):
         doc = await self.bot.db.backups.find_one({"_id": backup_id.lower(), "creator": creator}, projection=())
         return doc is not None
 
+    async def _compress_chunks(self, chunks):
+        dict_id = self.dict_id
+        return await self.bot.process_pool.run(
+            compress_chunks,
+            chunks,
+            config.BACKUP_CODEC,
+            dict_id,
+            export_dictionaries([dict_id])
+        )
+
+    async def _store_chunks(self, raw):
+        chunks = await self.bot.process_pool.run(split_chunks, raw)
+        hashes = [h for h, _, _ in chunks]
+        counts = Counter(hashes)
+
+        existing = set()
+        async for blob in self.bot.db.backup_blobs.find({"_id": {"$in": list(counts)}}, projection=()):
+            existing.add(blob["_id"])
+
+        missing = {h: raw[start:end] for h, start, end in chunks if h not in existing}
+        compressed = await self._compress_chunks(list(missing.items()))
+
+        await self.bot.db.backup_blobs.bulk_write([
+            pymongo.UpdateOne(
+                {"_id": h},
+                {
+                    "$inc": {"refs": count},
+                    "$setOnInsert": compressed[h]
+                } if h in compressed else {"$inc": {"refs": count}},
+                upsert=True
+            )
+            for h, count in counts.items()
+        ], ordered=False)
+
+        # A blob that existed during the lookup might have been released in the meantime and upserted without data,
+        # by this or by a concurrent save. Every save makes sure that its blobs have data before they are referenced.
+        empty = set()
+        async for blob in self.bot.db.backup_blobs.find(
+                {"_id": {"$in": list(counts)}, "data": {"$exists": False}},
+                projection=()
+        ):
+            empty.add(blob["_id"])
+
+        lost = {h: raw[start:end] for h, start, end in chunks if h in empty}
+        if lost:
+            compressed = await self._compress_chunks(list(lost.items()))
+            for h, blob in compressed.items():
+                await self.bot.db.backup_blobs.update_one({"_id": h, "data": {"$exists": False}}, {"$set": blob})
+
+        return hashes
+
+    async def _load_chunks(self, hashes):
+        blobs = {}
+        async for blob in self.bot.db.backup_blobs.find(
+                {"_id": {"$in": list(set(hashes))}},
+                projection=("data", "codec", "dict")
+        ):
+            blobs[blob["_id"]] = blob
+
+        missing = set(hashes) - {h for h, blob in blobs.items() if "data" in blob}
+        if missing:
+            raise ValueError(f"Missing backup chunks: {', '.join(missing)}")
+
+        dict_ids = await self._load_dictionaries(blobs)
+        return await self.bot.process_pool.run(decompress_chunks, blobs, hashes, export_dictionaries(dict_ids))
+
+    async def _load_dictionaries(self, blobs):
+        dict_ids = {blob.get("dict") for blob in blobs.values()} - {None}
+        for dict_id in dict_ids:
+            if not has_dictionary(dict_id):
+                await self._load_dictionary(dict_id)
+
+        return dict_ids
+
+    async def _load_dictionary(self, dict_id):
+        doc = await self.bot.db.backup_dicts.find_one({"_id": dict_id})
+        if doc is None:
+            raise ValueError(f"Missing compression dictionary {dict_id}")
+
+        register_dictionary(dict_id, doc["data"])
+
+    async def _refresh_dictionary(self):
+        doc = await self.bot.db.backup_dicts.find_one({}, sort=[("timestamp", pymongo.DESCENDING)])
+        if doc is not None:
+            register_dictionary(doc["_id"], doc["data"])
+            self.dict_id = doc["_id"]
+
+        return doc
+
+    async def _train_dictionary(self):
+        blobs = {}
+        async for blob in self.bot.db.backup_blobs.aggregate([
+            {"$match": {"size": {"$lte": DICTIONARY_MAX_SAMPLE_SIZE}}},
+            {"$sample": {"size": DICTIONARY_SAMPLES}},
+            {"$project": {"data": 1, "codec": 1, "dict": 1}}
+        ]):
+            blobs[blob["_id"]] = blob
+
+        dict_ids = await self._load_dictionaries(blobs)
+        trained = await self.bot.process_pool.run(train_dictionary, blobs, export_dictionaries(dict_ids))
+        if trained is None:
+            return
+
+        dict_id, data = trained
+        await self.bot.db.backup_dicts.update_one(
+            {"_id": dict_id},
+            {"$setOnInsert": {"data": data, "timestamp": datetime.utcnow()}},
+            upsert=True
+        )
+        register_dictionary(dict_id, data)
+        self.dict_id = dict_id
+
+    async def _release_chunks(self, hashes):
+        counts = Counter(hashes)
+        if len(counts) == 0:
+            return
+
+        await self.bot.db.backup_blobs.bulk_write([
+            pymongo.UpdateOne({"_id": h}, {"$inc": {"refs": -count}})
+            for h, count in counts.items()
+        ], ordered=False)
+        await self._delete_unreferenced_chunks(list(counts))
+
+    async def _delete_unreferenced_chunks(self, hashes):
+        # Chunks that are pinned by a running loading process are deleted when the last pin is removed
+        pinned = await self.bot.db.backup_pins.distinct("chunks", {
+            "chunks": {"$in": hashes},
+            "expires_at": {"$gt": datetime.utcnow()}
+        })
+        unpinned = list(set(hashes) - set(pinned))
+        if unpinned:
+            await self.bot.db.backup_blobs.delete_many({"_id": {"$in": unpinned}, "refs": {"$lte": 0}})
+
+    async def _stream_large_backup(self, file_id):
+        # Decompress the GridFS chunks as they arrive so the full compressed payload is never held in memory
+        grid_out = await self.grid_fs.open_download_stream(file_id)
+        decompressor = brotli.Decompressor()
+        raw = bytearray()
+        held = 0
+        peak = 0
+        try:
+            while True:
+                chunk = await grid_out.readchunk()
+                if not chunk:
+                    break
+
+                self.decoding_bytes += len(raw) + len(chunk) - held
+                held = len(raw) + len(chunk)
+                peak = max(peak, held)
+                raw += await self.bot.loop.run_in_executor(None, decompressor.process, chunk)
+        finally:
+            self.decoding_bytes -= held
+
+        if not decompressor.is_finished():
+            raise ValueError(f"Truncated backup file {file_id}")
+
+        metrics.observe("backup_stream_peak_bytes", max(peak, len(raw)), buckets=SIZE_BUCKETS)
+        return raw
+
+    def _invalidate_backup(self, backup_id):
+        for version in range(2, BACKUP_VERSION + 1):
+            self.backup_cache.delete((backup_id.lower(), version))
+
+    async def _decode_backup(self, doc):
+        key = (doc["_id"], doc.get("version", 2))
+        data = self.backup_cache.get(key)
+        if data is not None:
+            return data
+
+        if "chunks" in doc["data"]:
+            raw = await self._load_chunks(doc["data"]["chunks"])
+        else:
+            if doc.get("large"):
+                raw = await self._stream_large_backup(doc["data"]["raw"])
+            else:
+                raw = await self.bot.process_pool.run(brotli.decompress, doc["data"]["raw"])
+
+        data = backup_pb2.BackupData()
+        await self.bot.loop.run_in_executor(None, lambda: data.ParseFromString(raw))
+
+        delta = doc.get("delta")
+        if delta is not None:
+            base_doc = await self.bot.db.backups.find_one({"_id": delta["base"]})
+            if base_doc is None:
+                raise ValueError(f"Missing base backup {delta['base']}")
+
+            base = await self._decode_backup(base_doc)
+            data = await self.bot.loop.run_in_executor(None, lambda: apply_delta(
+                base, data, delta["removed"], delta.get("order")
+            ))
+
+        self.backup_cache.set(key, data)
+        return data
+
     async def _retrieve_backup(self, creator, backup_id):
         doc = await self.bot.db.backups.find_one({"_id": backup_id.lower(), "creator": creator})
         if doc is None:
             return None, None
 
-        if doc.get("large"):
-            grid_out = await self.grid_fs.open_download_stream(doc["data"]["raw"])
-            doc["data"]["raw"] = await grid_out.read()
+        data = await self._decode_backup(doc)
+        if "chunks" not in doc["data"]:
+            # Lazily move backups that have been stored before the chunk store existed
+            file_id = doc["data"]["raw"] if doc.get("large") else None
+            if doc["_id"] not in self.migrations:
+                task = self.bot.loop.create_task(self._migrate_backup(doc["_id"], file_id, data))
+                self.migrations[doc["_id"]] = task
+                task.add_done_callback(lambda t, backup_id=doc["_id"]: self._migration_done(backup_id, t))
 
-        data = backup_pb2.BackupData()
-        await self.bot.loop.run_in_executor(None, lambda: data.ParseFromString(brotli.decompress(doc["data"]["raw"])))
         del doc["data"]
         return doc, data
 
-    async def _store_backup(self, creator, data, interval=False, expires=True):
-        raw = await self.bot.loop.run_in_executor(None, lambda: brotli.compress(data.SerializeToString()))
+    def _migration_done(self, backup_id, task):
+        del self.migrations[backup_id]
+        if task.cancelled() or task.exception() is None:
+            metrics.inc("backup_migrations_total", result="success" if not task.cancelled() else "cancelled")
+            return
+
+        metrics.inc("backup_migrations_total", result="failed")
+        e = task.exception()
+        tb = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+        print(f"Migration Error ({backup_id}):\n", tb, file=sys.stderr)
+
+    async def _migrate_backup(self, backup_id, file_id, data):
+        raw = await self.bot.loop.run_in_executor(None, lambda: data.SerializeToString(deterministic=True))
+        chunks = await self._store_chunks(raw)
+
+        result = await self.bot.db.backups.update_one(
+            {"_id": backup_id, "data.chunks": {"$exists": False}},
+            {
+                "$set": {
+                    "version": BACKUP_VERSION,
+                    "large": False,
+                    "data.chunks": chunks,
+                    "data.summary": create_summary(data),
+                    "data.translated_ids": translated_ids(data)
+                },
+                "$unset": {"data.raw": ""}
+            }
+        )
+        if result.modified_count == 0:
+            await self._release_chunks(chunks)
+            return
+
+        self._invalidate_backup(backup_id)
+        self.backup_cache.set((backup_id, BACKUP_VERSION), data)
+        if file_id is not None:
+            try:
+                await self.grid_fs.delete(file_id)
+            except gridfs.NoFile:
+                pass
+
+    async def _replace_chunks(self, backup_id, old_chunks, data, delta=None):
+        raw = await self.bot.loop.run_in_executor(None, lambda: data.SerializeToString(deterministic=True))
+        chunks = await self._store_chunks(raw)
+
+        update = {"$set": {"data.chunks": chunks}}
+        if delta is not None:
+            update["$set"]["delta"] = delta
+        else:
+            update["$unset"] = {"delta": ""}
+
+        result = await self.bot.db.backups.update_one({"_id": backup_id, "data.chunks": old_chunks}, update)
+        if result.modified_count == 0:
+            # The backup has been deleted or changed in the meantime
+            await self._release_chunks(chunks)
+            return False
+
+        await self._release_chunks(old_chunks)
+        return True
+
+    async def _convert_to_delta(self, backup_id, base_id, base_data):
+        doc = await self.bot.db.backups.find_one(
+            {"_id": backup_id},
+            projection=("version", "data.chunks", "delta", "rebase")
+        )
+        if doc is None or doc.get("delta") or doc.get("rebase") or "chunks" not in doc["data"]:
+            return False
+
+        data = await self._decode_backup(doc)
+        partial, removed, order = await self.bot.loop.run_in_executor(None, lambda: make_delta(base_data, data))
+        metrics.observe("backup_delta_ratio", partial.ByteSize() / max(data.ByteSize(), 1),
+                        buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 1))
+        return await self._replace_chunks(backup_id, doc["data"]["chunks"], partial, delta={
+            "base": base_id,
+            "removed": removed,
+            "order": order
+        })
+
+    async def _detach_dependents(self, backup_id):
+        # Backups that are stored as a delta against this backup need to become full snapshots again
+        async for doc in self.bot.db.backups.find({"delta.base": backup_id}):
+            data = await self._decode_backup(doc)
+            await self._replace_chunks(doc["_id"], doc["data"]["chunks"], data)
+
+    async def _store_backup(self, creator, data, interval=False, expires=True, rebase=False):
+        raw = await self.bot.loop.run_in_executor(None, lambda: data.SerializeToString(deterministic=True))
+        chunks = await self._store_chunks(raw)
         backup_id = unique_id().upper()
 
         expires_at = datetime.utcnow() + timedelta(days=365)
@@ -1371,114 +2259,376 @@ class BackupsModule(Module):
             "_id": backup_id.lower(),
             "creator": creator,
             "timestamp": datetime.utcnow(),
-            "version": 2,
+            "version": BACKUP_VERSION,
             "interval": interval,
+            "rebase": rebase,
             "large": False,
             "expires_at": expires_at if expires else None,
             "data": {
                 "id": data.id,
                 "name": data.name,
-                "raw": raw
+                "summary": create_summary(data),
+                # Loads by reference read only these ids from the translator without decoding the backup
+                "translated_ids": translated_ids(data),
+                "chunks": chunks
             },
         }
 
         try:
             await self.bot.db.backups.insert_one(doc)
-        except pymongo.errors.DocumentTooLarge:
-            doc["data"]["raw"] = backup_id
-            doc["large"] = True
-            await self.grid_fs.upload_from_stream_with_id(backup_id, backup_id, raw)
-            await self.bot.db.backups.insert_one(doc)
+        except pymongo.errors.PyMongoError:
+            await self._release_chunks(chunks)
+            raise
 
+        await self._change_backup_count(creator, 1)
         return backup_id
 
     async def _delete_backup(self, creator, backup_id):
+        if not await self._backup_exists(creator, backup_id):
+            return False
+
+        await self._detach_dependents(backup_id.lower())
+        self._invalidate_backup(backup_id)
+        # Backups that are being purged release their chunks in the purge
         doc = await self.bot.db.backups.find_one_and_delete(
-            {"creator": creator, "_id": backup_id.lower()},
-            projection=("large", "_id")
+            {"creator": creator, "_id": backup_id.lower(), "purging": None},
+            projection=("large", "_id", "data.raw", "data.chunks")
         )
         if doc is None:
             return False
 
         if doc.get("large"):
             try:
-                await self.grid_fs.delete(doc["_id"])
+                # The file id is the upper case backup id and not the _id of the document
+                await self.grid_fs.delete(doc["data"]["raw"])
             except gridfs.NoFile:
                 pass
 
+        await self._release_chunks(doc.get("data", {}).get("chunks", []))
+        await self._change_backup_count(creator, -1)
         return True
 
-    async def _delete_backups(self, _filter):
-        result = await self.bot.db.backups.delete_many({"large": {"$ne": True}, **_filter})
-        count = 0
-        async for backup in self.bot.db.backups.find(_filter, projection=("creator", "_id")):
-            count += 1
-            await self._delete_backup(backup["creator"], backup["_id"])
+    async def _delete_grid_files(self, file_ids):
+        await self.bot.db.backup_chunks.files.delete_many({"_id": {"$in": file_ids}})
+        await self.bot.db.backup_chunks.chunks.delete_many({"files_id": {"$in": file_ids}})
+
+    async def _delete_backup_batch(self, backups):
+        for backup in backups:
+            self._invalidate_backup(backup["_id"])
+
+        # The backups are claimed before they are deleted so only the backups that have actually been deleted by this
+        # call release their chunks, backups that have been deleted or claimed in the meantime are released elsewhere
+        token = unique_id()
+        now = datetime.utcnow()
+        await self.bot.db.backups.update_many(
+            {
+                "_id": {"$in": [backup["_id"] for backup in backups]},
+                "$or": [{"purging": None}, {"purging_at": {"$lt": now - PURGE_CLAIM_TIMEOUT}}]
+            },
+            {"$set": {"purging": token, "purging_at": now}}
+        )
+        deleted = [
+            backup
+            async for backup in self.bot.db.backups.find(
+                {"purging": token},
+                projection=("creator", "large", "data.raw", "data.chunks")
+            )
+        ]
+        await self.bot.db.backups.delete_many({"purging": token})
+
+        file_ids = [backup["data"]["raw"] for backup in deleted if backup.get("large")]
+        if file_ids:
+            await self._delete_grid_files(file_ids)
+
+        await self._release_chunks([h for backup in deleted for h in backup.get("data", {}).get("chunks", [])])
+        creators = Counter(backup["creator"] for backup in deleted)
+        for creator, count in creators.items():
+            await self._change_backup_count(creator, -count)
+
+        return len(deleted)
+
+    async def _delete_backups(self, _filter, progress=None, limit=None):
+        """
+        Delete all backups that match the filter in batches
+
+        progress is awaited with the number of deleted and total backups after every batch. If limit is given, at most
+        that many backups are deleted.
+        """
+        backups = [
+            backup
+            async for backup in self.bot.db.backups.find(
+                {**_filter, "large": {"$ne": True}},
+                projection=("creator", "data.chunks"),
+                limit=limit or 0
+            )
+        ]
+        if limit is None or len(backups) < limit:
+            backups.extend([
+                backup
+                async for backup in self.bot.db.backups.find(
+                    {**_filter, "large": True},
+                    projection=("creator", "large", "data.raw"),
+                    limit=limit - len(backups) if limit else 0
+                )
+            ])
+
+        if len(backups) == 0:
+            return 0
+
+        # Backups that are stored as a delta against a purged backup need to become full snapshots again
+        backup_ids = [backup["_id"] for backup in backups]
+        async for doc in self.bot.db.backups.find({"delta.base": {"$in": backup_ids}, "_id": {"$nin": backup_ids}}):
+            data = await self._decode_backup(doc)
+            await self._replace_chunks(doc["_id"], doc["data"]["chunks"], data)
+
+        deleted = 0
+        semaphore = asyncio.Semaphore(PURGE_CONCURRENCY)
+
+        async def _delete_batch(batch):
+            nonlocal deleted
+            async with semaphore:
+                deleted += await self._delete_backup_batch(batch)
+                if progress is not None:
+                    await progress(deleted, len(backups))
+
+        await asyncio.gather(*[
+            _delete_batch(backups[i:i + PURGE_BATCH_SIZE])
+            for i in range(0, len(backups), PURGE_BATCH_SIZE)
+        ])
+        metrics.inc("backups_purged_total", deleted)
+        return deleted
+
+    async def _create_interval_backup(self, interval):
+        start = time.perf_counter()
+        try:
+            reply = await last_reply(self.bot.rpc.backups.Create(backup_pb2.CreateRequest(
+                guild_id=interval["guild"],
+                options=["roles", "channels", "settings"],
+                message_count=0
+            )))
+        except AioRpcError as e:
+            if e.code() == grpc.StatusCode.NOT_FOUND:
+                await self.bot.db.intervals.delete_many({"guild": interval["guild"]})
+                return False
+            elif e.code() in OVERLOAD_CODES:
+                self.interval_limiter.overload()
+
+            raise
+
+        self.interval_limiter.success(time.perf_counter() - start)
+
+        data = reply.data
+        if data is None:
+            return True
+
+        keep = max(interval.get("keep", 1), 1)
+        existing = [
+            backup["_id"]
+            async for backup in self.bot.db.backups.find({
+                "data.id": interval["guild"],
+                "creator": interval["user"],
+                "interval": True,
+            }, sort=[("timestamp", pymongo.DESCENDING)], projection=[])
+        ]
+        excess = existing[keep - 1:]
+        if len(excess) > 0:
+            await self._delete_backups({"creator": interval["user"], "_id": {"$in": excess}})
+
+        previous = existing[0] if keep > 1 and len(existing) > 0 else None
+        runs = interval.get("runs", 0) + 1
+        backup_id = await self._store_backup(
+            interval["user"], data,
+            interval=True,
+            rebase=runs % INTERVAL_REBASE_EVERY == 0
+        )
+
+        # The newest interval backup is always a full snapshot, the previous one can become a delta against it.
+        # Most of its chunks are shared with the new snapshot anyway, so this is only worth the CPU for guilds that
+        # change a lot between two runs.
+        if previous is not None and config.BACKUP_INTERVAL_DELTAS:
+            await self._convert_to_delta(previous, backup_id.lower(), data)
 
-        return result.deleted_count + count
+        return True
 
-    async def _run_interval(self, semaphore, interval):
+    async def _run_interval(self, interval):
         try:
-            _next = interval["next"]
+            # Retries only move next, the regular schedule continues from the time the failed run was due
+            scheduled = interval.get("scheduled") or interval["next"]
+            _next = scheduled
             try:
                 while _next < datetime.utcnow():
                     _next += timedelta(hours=max(interval["interval"], 1))
             except OverflowError:
                 # interval length goes brrr
                 await self.bot.db.intervals.delete_one({"_id": interval["_id"]})
-
-            await self.bot.db.intervals.update_one({"_id": interval["_id"]}, {"$set": {
-                "next": _next,
-                "last": datetime.utcnow()
-            }})
+                return
 
             try:
-                replies = [resp async for resp in self.bot.rpc.backups.Create(backup_pb2.CreateRequest(
-                    guild_id=interval["guild"],
-                    options=["roles", "channels", "settings"],
-                    message_count=0
-                ))]
-            except AioRpcError as e:
-                if e.code() == grpc.StatusCode.NOT_FOUND:
-                    await self.bot.db.intervals.delete_many({"guild": interval["guild"]})
+                if not await self._create_interval_backup(interval):
+                    metrics.inc("interval_runs_total", result="not_found")
                     return
-                else:
+            except Exception as e:
+                if isinstance(e, asyncio.CancelledError):
                     raise
 
-            data = replies[-1].data
-            if data is None:
-                return
+                tb = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+                print("Interval Error:\n", tb, file=sys.stderr)
+
+                failures = interval.get("failures", 0) + 1
+                if failures <= INTERVAL_MAX_RETRIES:
+                    # Retry with exponential backoff, but never later than the next regular run
+                    retry_at = datetime.utcnow() + INTERVAL_RETRY_BACKOFF * 2 ** (failures - 1)
+                    metrics.inc("interval_runs_total", result="retry")
+                    await self.bot.db.intervals.update_one(
+                        {"_id": interval["_id"], "owner": self.interval_owner},
+                        {
+                            "$set": {"next": min(retry_at, _next), "scheduled": scheduled, "failures": failures},
+                            "$unset": {"owner": "", "lease": ""}
+                        }
+                    )
+                    return
 
-            keep = interval.get("keep", 1)
-            if keep == 1:
-                await self.bot.db.backups.delete_many({
-                    "data.id": interval["guild"],
-                    "creator": interval["user"],
-                    "interval": True,
-                })
+                # Give up and wait for the next regular run
+                metrics.inc("interval_runs_total", result="failed")
             else:
-                existing_count = 0
-                async for backup in self.bot.db.backups.find({
-                    "data.id": interval["guild"],
-                    "creator": interval["user"],
-                    "interval": True,
-                }, sort=[("timestamp", pymongo.DESCENDING)], projection=[]):
-                    existing_count += 1
-                    if existing_count >= keep:
-                        await self.bot.db.backups.delete_one({"_id": backup["_id"]})
-
-            await self._store_backup(interval["user"], data, interval=True)
+                metrics.inc("interval_runs_total", result="success")
+
+            await self.bot.db.intervals.update_one({"_id": interval["_id"], "owner": self.interval_owner}, {
+                "$set": {
+                    "next": _next,
+                    "last": datetime.utcnow(),
+                    "failures": 0
+                },
+                "$unset": {"owner": "", "lease": "", "scheduled": ""},
+                "$inc": {"runs": 1}
+            })
         finally:
-            semaphore.release()
+            self.interval_limiter.release()
 
-    @Module.task(minutes=5)
+    async def _claim_interval(self):
+        now = datetime.utcnow()
+        return await self.bot.db.intervals.find_one_and_update(
+            {
+                "next": {"$lt": now},
+                "$or": [{"lease": None}, {"lease": {"$lt": now}}]
+            },
+            {"$set": {"owner": self.interval_owner, "lease": now + INTERVAL_LEASE}},
+            sort=[("next", pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+
+    @Module.task(minutes=60)
+    async def dictionary_task(self):
+        doc = await self._refresh_dictionary()
+        if config.BACKUP_CODEC != "zstd":
+            return
+
+        if doc is not None and doc["timestamp"] > datetime.utcnow() - DICTIONARY_MAX_AGE:
+            return
+
+        # Only one worker has to train a new dictionary, the others pick it up on their next refresh
+        if await self.bot.redis.set("backups:dictionary", "1", expire=60 * 60 * 24, exist="SET_IF_NOT_EXIST"):
+            await self._train_dictionary()
+
+    async def _sweep_orphaned_files(self):
+        # GridFS files that don't belong to a large backup anymore
+        deleted = 0
+        batch = []
+        files = self.bot.db.backup_chunks.files.find(
+            {"uploadDate": {"$lt": datetime.utcnow() - ORPHAN_MIN_AGE}},
+            projection=("_id",)
+        )
+        async for file in files:
+            batch.append(file["_id"])
+            if len(batch) < PURGE_BATCH_SIZE:
+                continue
+
+            deleted += await self._delete_orphaned_files(batch)
+            batch = []
+
+        if batch:
+            deleted += await self._delete_orphaned_files(batch)
+
+        # GridFS chunks whose file document doesn't exist anymore
+        # The file ids are streamed from a cursor, distinct would have to fit all of them into a single document
+        batch = []
+        file_ids = self.bot.db.backup_chunks.chunks.aggregate([{"$group": {"_id": "$files_id"}}], allowDiskUse=True)
+        async for file in file_ids:
+            batch.append(file["_id"])
+            if len(batch) < PURGE_BATCH_SIZE:
+                continue
+
+            deleted += await self._delete_orphaned_chunks(batch)
+            batch = []
+
+        if batch:
+            deleted += await self._delete_orphaned_chunks(batch)
+
+        metrics.inc("backup_orphaned_files_total", deleted)
+        return deleted
+
+    async def _delete_orphaned_files(self, file_ids):
+        used = await self.bot.db.backups.distinct("data.raw", {"large": True, "data.raw": {"$in": file_ids}})
+        orphans = list(set(file_ids) - set(used))
+        if orphans:
+            await self._delete_grid_files(orphans)
+
+        return len(orphans)
+
+    async def _delete_orphaned_chunks(self, file_ids):
+        existing = await self.bot.db.backup_chunks.files.distinct("_id", {"_id": {"$in": file_ids}})
+        orphans = list(set(file_ids) - set(existing))
+        if orphans:
+            await self.bot.db.backup_chunks.chunks.delete_many({"files_id": {"$in": orphans}})
+
+        return len(orphans)
+
+    @Module.task(hours=1)
+    async def expiry_task(self):
+        # Expired backups are deleted like any other backup so they release their chunks and update the counts,
+        # only one worker has to sweep. The number per run is limited, a backlog is worked off over the next runs.
+        if await self.bot.redis.set("backups:expiry", "1", expire=60 * 50, exist="SET_IF_NOT_EXIST"):
+            await self._delete_backups(
+                {"expires_at": {"$type": "date", "$lt": datetime.utcnow()}},
+                limit=EXPIRY_LIMIT
+            )
+            await self._sweep_expired_pins()
+
+    @Module.task(hours=24)
+    async def orphan_task(self):
+        # Only one worker has to sweep
+        if await self.bot.redis.set("backups:orphans", "1", expire=60 * 60 * 23, exist="SET_IF_NOT_EXIST"):
+            await self._sweep_orphaned_files()
+
+    @Module.task(minutes=1)
     async def interval_task(self):
-        tasks = []
-        semaphore = asyncio.Semaphore(5)
-        to_backup = self.bot.db.intervals.find({"next": {"$lt": datetime.utcnow()}})
-        async for interval in to_backup:
-            await semaphore.acquire()
-            tasks.append(self.bot.loop.create_task(self._run_interval(semaphore, interval)))
-
-        if len(tasks) != 0:
-            await asyncio.wait(tasks, return_when=asyncio.ALL_COMPLETED)
+        # Intervals are claimed one by one with a lease, this way multiple workers can run intervals at the same time
+        # without running the same interval twice. Leases of crashed workers expire and are picked up by others.
+        metrics.set("interval_backlog", await self.bot.db.intervals.count_documents({
+            "next": {"$lt": datetime.utcnow()}
+        }))
+        # The previous run keeps claiming intervals as long as there are due ones, slots that become free are used
+        # right away instead of on the next run
+        if self.interval_claiming:
+            return
+
+        self.interval_claiming = True
+        try:
+            while True:
+                await self.interval_limiter.acquire()
+                try:
+                    interval = await self._claim_interval()
+                except BaseException:
+                    # The slot would otherwise be lost and the limiter would block all following runs
+                    self.interval_limiter.release()
+                    raise
+
+                if interval is None:
+                    self.interval_limiter.release()
+                    return
+
+                task = self.bot.loop.create_task(self._run_interval(interval))
+                self.interval_tasks.add(task)
+                task.add_done_callback(self.interval_tasks.discard)
+        finally:
+            self.interval_claiming = False
@@ -3,6 +3,8 @@ import traceback
 from dbots import *
 from dbots.cmd import *
 
+from util import auto_defer
+
 
 class CloneModule(Module):
     @Module.command(default_member_permissions=Permissions.FlagList.administrator, dm_permission=False)
@@ -21,6 +23,7 @@ class CloneModule(Module):
     @checks.bot_has_permissions("manage_channels")
     @checks.not_in_maintenance
     @checks.cooldown(2, 30, bucket=checks.CooldownType.GUILD, manual=True)
+    @auto_defer(ephemeral=True)
     async def channel(self, ctx, channel: CommandOptionType.CHANNEL, child_channels: bool = False):
         """
         Create a clone of channel including permission overwrites
@@ -88,6 +91,7 @@ class CloneModule(Module):
     @checks.bot_has_permissions("manage_channels", "manage_roles")
     @checks.not_in_maintenance
     @checks.cooldown(3, 60, bucket=checks.CooldownType.GUILD, manual=True)
+    @auto_defer(ephemeral=True)
     async def role(self, ctx, role: CommandOptionType.ROLE, apply_overwrites: bool = False):
         """
         Create a clone of a role optionally including channel permission overwrites
@@ -5,6 +5,7 @@ import json
 import csv
 import re
 
+from util import auto_defer
 from .premium import PREMIUM_ONLY_TEXT, PREMIUM_COMPONENTS
 
 
@@ -55,6 +56,7 @@ class ExportModule(Module):
     ))
     @has_permissions_level()
     @checks.cooldown(1, 15, bucket=checks.CooldownType.AUTHOR)
+    @auto_defer(ephemeral=True)
     async def channels(self, ctx, format):
         """
         Export all channels as JSON or CSV
@@ -74,6 +76,7 @@ class ExportModule(Module):
     ))
     @has_permissions_level()
     @checks.cooldown(3, 15, bucket=checks.CooldownType.AUTHOR)
+    @auto_defer(ephemeral=True)
     async def channel(self, ctx, channel: CommandOptionType.CHANNEL):
         """
         Export a channel or category as JSON or CSV
@@ -99,6 +102,7 @@ class ExportModule(Module):
     ))
     @has_permissions_level()
     @checks.cooldown(1, 15, bucket=checks.CooldownType.AUTHOR)
+    @auto_defer(ephemeral=True)
     async def roles(self, ctx, format):
         """
         Export all roles as JSON or CSV
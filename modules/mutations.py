@@ -111,6 +111,7 @@ class MutationsModule(Module):
     @checks.guild_only
     @entitlement_required
     @checks.has_permissions_level()
+    @auto_defer(ephemeral=True)
     async def enable(self, ctx):
         """
         Enable change tracking for this server
@@ -128,6 +129,7 @@ class MutationsModule(Module):
     @checks.guild_only
     @entitlement_required
     @checks.has_permissions_level()
+    @auto_defer(ephemeral=True)
     async def disable(self, ctx):
         """
         Disable change logging for this server
@@ -301,6 +303,7 @@ class MutationsModule(Module):
         )
 
     @Module.component(name="change_revert_preview")
+    @auto_defer()
     async def revert_preview(self, ctx, mode, mutation_id):
         start_snapshot_id, mutation_hash = mutation_id.split("_")
 
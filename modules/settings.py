@@ -1,6 +1,8 @@
 from dbots.cmd import *
 from dbots import Permissions
 
+from util import auto_defer
+
 PERMISSION_DESCRIPTIONS = {
     checks.PermissionLevels.ADMIN_ONLY: "Server admins can create backups, enable the backup interval and "
                                         "load a template or backup",
@@ -20,6 +22,7 @@ class SettingsModule(Module):
     @settings.sub_command()
     @has_permissions(administrator=True)
     @cooldown(2, 10, bucket=checks.CooldownType.GUILD)
+    @auto_defer(ephemeral=True)
     async def show(self, ctx):
         """
         Show the current settings for this server
@@ -43,6 +46,7 @@ class SettingsModule(Module):
     @settings.sub_command()
     @checks.is_guild_owner
     @checks.cooldown(1, 10, bucket=checks.CooldownType.GUILD)
+    @auto_defer(ephemeral=True)
     async def reset(self, ctx):
         """
         Reset the settings for this server to the default values
@@ -78,6 +82,7 @@ class SettingsModule(Module):
     )
     @checks.is_guild_owner
     @checks.cooldown(1, 10, bucket=checks.CooldownType.GUILD)
+    @auto_defer(ephemeral=True)
     async def permissions(self, ctx, level):
         """
         Set the permissions mode for this server
@@ -129,6 +134,7 @@ class SettingsModule(Module):
         )
 
     @Module.component()
+    @auto_defer()
     async def opt_out_confirm(self, ctx):
         # Force user into the database
         resp = await ctx.bot.session.get(f"https://xenon.bot/api/v1/users/{ctx.author.id}")
@@ -152,6 +158,7 @@ class SettingsModule(Module):
         ))
 
     @opt.sub_command(name="in")
+    @auto_defer(ephemeral=False)
     async def opt_in(self, ctx):
         """
         Opt in to end-user-data collection for your discord account (if you have previously opted out)
@@ -9,13 +9,21 @@ from dbots.cmd import *
 from grpc.aio import AioRpcError
 from xenon.backups import backup_pb2
 
+from util import LRUCache, auto_defer
 from .audit_logs import AuditLogType
-from .backups import option_status_list, convert_v1_to_v2, channel_tree, parse_options, create_warning_message
+from .backups import convert_v1_to_v2, create_summary, parse_options, create_warning_message, \
+    last_reply, load_progress_message, ProgressUpdater, get_load_status, load_status_message, translated_ids, \
+    load_translator, save_translator
 
 ALLOWED_OPTIONS = ("delete_roles", "delete_channels", "roles", "channels", "settings")
 
 
 class TemplatesModule(Module):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.status_flights = {}
+        self.status_messages = LRUCache("template_status_messages", 256)
+
     async def _get_template(self, identifier):
         template = await self.bot.db.templates.find_one({
             "internal": True,
@@ -139,6 +147,7 @@ class TemplatesModule(Module):
     @checks.bot_has_permissions("administrator")
     @checks.not_in_maintenance
     @checks.cooldown(1, 5 * 60, bucket=checks.CooldownType.GUILD, manual=True)
+    @auto_defer(ephemeral=True)
     async def load(self, ctx, name_or_id: str.strip, options: str.lower = ""):
         """
         Load one of the public templates
@@ -171,6 +180,7 @@ class TemplatesModule(Module):
             ephemeral=True)
 
     @Module.component(name="template_load_options")
+    @auto_defer()
     async def load_options(self, ctx, redis_key):
         scope = await ctx.bot.redis.get(redis_key)
         if scope is None:
@@ -196,6 +206,7 @@ class TemplatesModule(Module):
         ), ephemeral=True)
 
     @Module.component(name="template_load_confirm")
+    @auto_defer()
     async def load_confirm(self, ctx, redis_key):
         scope = await ctx.bot.redis.get(redis_key)
         if scope is None:
@@ -239,13 +250,7 @@ class TemplatesModule(Module):
             "extra": {}
         })
 
-        ids = {}
-        translator = await ctx.bot.db.id_translators.find_one({
-            "target_id": ctx.guild_id,
-            "source_id": data.id
-        })
-        if translator is not None:
-            ids = translator.get("ids", {})
+        ids = await load_translator(ctx.bot.db, ctx.guild_id, data.id, keys=translated_ids(data))
 
         await ctx.update(**create_message(
             "**The template is now loading**. Please be patient, this can take a while!\n\n"
@@ -255,14 +260,14 @@ class TemplatesModule(Module):
         ))
 
         try:
-            replies = [reply async for reply in self.bot.rpc.backups.Load(backup_pb2.LoadRequest(
+            reply = await last_reply(self.bot.rpc.backups.Load(backup_pb2.LoadRequest(
                 guild_id=ctx.guild_id,
                 options=list(options),
                 message_count=0,
                 data=data,
                 reason="Template loaded by " + str(ctx.author),
                 ids=ids
-            ))]
+            )), progress=ProgressUpdater(ctx.update, lambda r: load_progress_message(r, "template")))
         except AioRpcError as e:
             if e.code() == grpc.StatusCode.ALREADY_EXISTS:
                 await ctx.update(**create_message(
@@ -309,31 +314,13 @@ class TemplatesModule(Module):
             pass
 
         # Save ids for later use and recovery
-        await ctx.bot.db.id_translators.update_one(
-            {
-                "target_id": ctx.guild_id,
-                "source_id": data.id,
-            },
-            {
-                "$set": {
-                    "target_id": ctx.guild_id,
-                    "source_id": data.id,
-                    **{
-                        f"ids.{s}": t
-                        for s, t in replies[-1].ids.items()
-                    }
-                },
-                "$addToSet": {
-                    "loaders": ctx.author.id
-                }
-            },
-            upsert=True
-        )
+        await save_translator(ctx.bot.db, ctx.guild_id, data.id, reply.ids, ids, ctx.author.id)
 
     @template.sub_command()
     @checks.guild_only
     @checks.has_permissions_level(destructive=True)
     @checks.cooldown(2, 30, bucket=checks.CooldownType.GUILD)
+    @auto_defer(ephemeral=True)
     async def cancel(self, ctx):
         """
         Cancel the currently running loading process on this server
@@ -359,50 +346,20 @@ class TemplatesModule(Module):
     @checks.guild_only
     @checks.has_permissions_level()
     @checks.cooldown(2, 10, bucket=checks.CooldownType.GUILD)
+    @auto_defer(ephemeral=True)
     async def status(self, ctx):
         """
         Get the status of the currently running loading process
         """
-        try:
-            reply = await self.bot.rpc.backups.LoadStatus(backup_pb2.LoadStatusRequest(guild_id=ctx.guild_id))
-        except AioRpcError as e:
-            if e.code() == grpc.StatusCode.NOT_FOUND:
-                await ctx.respond(**create_message(
-                    "There is **no loading process running** on this server.",
-                    f=Format.ERROR
-                ), ephemeral=True)
-                return
-            else:
-                raise
-
-        estimated_time_left = sum([
-            o.estimated_time_left
-            for o in reply.options.values()
-            if o.state != backup_pb2.LoadStatus.State.STATE_WAITING
-        ])
-
-        minutes = estimated_time_left // 60
-        seconds = estimated_time_left % 60
-        if minutes == 0:
-            etl = "< 1 minute"
-        else:
-            etl = timedelta_to_string(timedelta(minutes=minutes + int(seconds > 0)))
-
-        details = "\n\n" + "\n".join([f"```{o.details}```" for o in reply.options.values() if o.details])
-        for o in reply.options.values():
-            if o.state == backup_pb2.LoadStatus.State.STATE_RATE_LIMIT:
-                details += f"\n```A long lasting ratelimit has been hit, " \
-                           f"you might want to cancel the loading process.```"
-                break
+        status = await get_load_status(self.bot, ctx.guild_id, self.status_flights)
+        if status is None:
+            await ctx.respond(**create_message(
+                "There is **no loading process running** on this server.",
+                f=Format.ERROR
+            ), ephemeral=True)
+            return
 
-        await ctx.respond(**create_message(
-            f"Estimated time required for this step: `{etl}`\n\n"
-            f"Type `/template cancel` to cancel the loading process.\n\n"
-            f"{option_status_list(reply.options)}"
-            f"{details}",
-            title="Loading Status",
-            f=Format.INFO
-        ), ephemeral=True)
+        await ctx.respond(**load_status_message(status, "template", self.status_messages), ephemeral=True)
 
     @template.sub_command()
     async def list(self, ctx):
@@ -422,6 +379,7 @@ class TemplatesModule(Module):
         )
     ))
     @checks.cooldown(2, 10, bucket=checks.CooldownType.AUTHOR)
+    @auto_defer(ephemeral=True)
     async def info(self, ctx, name_or_id: str.strip):
         """
         Get information about a public template
@@ -436,15 +394,7 @@ class TemplatesModule(Module):
             return
 
         data = convert_v1_to_v2(template["data"])
-        channel_list = channel_tree(data.channels)
-        if len(channel_list) > 1024:
-            channel_list = channel_list[:1000] + "\n...\n```"
-
-        role_list = "```{}```".format("\n".join(
-            [r.name for r in sorted(data.roles, key=lambda r: r.position, reverse=True)]
-        ))
-        if len(role_list) > 1024:
-            role_list = role_list[:1000] + "\n...\n```"
+        summary = create_summary(data)
 
         description = template.get("description") or "No description"
         await ctx.respond(embeds=[{
@@ -468,12 +418,12 @@ class TemplatesModule(Module):
                 },
                 {
                     "name": "Channels",
-                    "value": channel_list,
+                    "value": summary["channel_tree"],
                     "inline": True
                 },
                 {
                     "name": "Roles",
-                    "value": role_list,
+                    "value": summary["role_list"],
                     "inline": True
                 },
             ]
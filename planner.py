@@ -0,0 +1,89 @@
+import math
+
+__all__ = (
+    "SECONDS_PER_CALL",
+    "count_api_calls",
+    "size_class",
+    "plan_load",
+    "update_factor",
+)
+
+# Rough cost of a single API call per option, used until enough loads have been recorded
+SECONDS_PER_CALL = dict(
+    delete_roles=0.5,
+    delete_channels=0.5,
+    roles=1,
+    channels=1,
+    settings=1,
+    bans=0.2,
+    members=0.5,
+    messages=1
+)
+
+# Weight of the latest load when updating the learned cost of an option
+LEARNING_RATE = 0.2
+
+
+def count_api_calls(option, backup, guild):
+    """
+    Count the API calls that are required to load an option
+
+    backup and guild map roles, channels, members and bans to their counts in the backup and the guild.
+    """
+    if option == "delete_roles":
+        return guild.get("roles", 0)
+    elif option == "delete_channels":
+        return guild.get("channels", 0)
+    elif option == "settings":
+        return 1
+    elif option == "messages":
+        # Messages are never loaded by the bot (message_count=0)
+        return 0
+
+    return backup.get(option, 0)
+
+
+def size_class(calls):
+    # Loads are grouped by the order of magnitude of their API calls, large loads hit rate limits more often
+    return int(math.log2(calls + 1))
+
+
+def plan_load(options, backup, guild, factors=None, buckets=None):
+    """
+    Predict the API calls and the time that is required to load the options
+
+    factors maps (option, size class) to the learned seconds per API call. buckets maps options to the state of the
+    rate limit bucket they depend on ({"remaining": ..., "time_remaining": ...}). If a bucket doesn't have enough
+    calls remaining, the option has to wait for it to reset.
+    Returns a dict with the per option steps, the total seconds and whether any option is blocked by a bucket.
+    """
+    factors = factors or {}
+    buckets = buckets or {}
+
+    steps = []
+    for option in options:
+        calls = count_api_calls(option, backup, guild)
+        per_call = factors.get((option, size_class(calls)), SECONDS_PER_CALL.get(option, 1))
+        wait = 0
+        bucket = buckets.get(option)
+        if bucket is not None and bucket["remaining"] < calls:
+            wait = bucket["time_remaining"]
+
+        steps.append(dict(option=option, calls=calls, seconds=calls * per_call, wait=wait))
+
+    return dict(
+        steps=steps,
+        calls=sum(step["calls"] for step in steps),
+        seconds=sum(step["seconds"] + step["wait"] for step in steps),
+        blocked=any(step["wait"] > 0 for step in steps)
+    )
+
+
+def update_factor(factor, predicted, actual):
+    """
+    Move a learned seconds per call factor towards the one that would have predicted the actual duration
+    """
+    if predicted <= 0:
+        return factor
+
+    return factor + LEARNING_RATE * (factor * actual / predicted - factor)
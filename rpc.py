@@ -0,0 +1,243 @@
+import asyncio
+import itertools
+import time
+
+import grpc
+import grpc.aio
+from grpc.aio import AioRpcError
+from xenon.backups import backup_pb2_grpc
+from xenon.mutations import service_pb2_grpc as mutation_pb2_grpc
+
+import config
+from metrics import metrics
+
+__all__ = (
+    "RpcCollection",
+    "ChannelPool",
+    "PooledStub",
+    "MethodPolicy",
+    "POLICIES",
+)
+
+CHANNEL_OPTIONS = [
+    ("grpc.max_message_length", 256 * 1024 * 1024),
+    ("grpc.max_receive_message_length", 256 * 1024 * 1024),
+    ("grpc.max_send_message_length", 256 * 1024 * 1024),
+    # Every channel gets its own connection instead of sharing one with the other channels to the same endpoint
+    ("grpc.use_local_subchannel_pool", 1),
+    ("grpc.keepalive_time_ms", 30 * 1000),
+    ("grpc.keepalive_timeout_ms", 10 * 1000),
+    ("grpc.keepalive_permit_without_calls", 1),
+    ("grpc.http2.max_pings_without_data", 0),
+]
+
+UNHEALTHY_STATES = {grpc.ChannelConnectivity.TRANSIENT_FAILURE, grpc.ChannelConnectivity.SHUTDOWN}
+RETRYABLE_CODES = {grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED}
+
+
+class MethodPolicy:
+    """
+    How calls to a method are made
+
+    timeout is the deadline of every attempt in seconds. retries and hedge_after must only be used for idempotent
+    unary methods: failed attempts with a retryable status are retried up to retries times with exponential backoff
+    and if an attempt didn't complete after hedge_after seconds, a second attempt is sent over another channel and the
+    first reply wins.
+    """
+
+    def __init__(self, timeout=None, retries=0, backoff=0.1, hedge_after=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+
+
+DEFAULT_POLICY = MethodPolicy(timeout=60)
+
+POLICIES = {
+    "backups": {
+        "Create": MethodPolicy(timeout=10 * 60),
+        # Loading a large backup can take hours, the stream stays open until it's done
+        "Load": MethodPolicy(timeout=24 * 60 * 60),
+        "LoadStatus": MethodPolicy(timeout=5, retries=2, hedge_after=0.5),
+        "CancelLoad": MethodPolicy(timeout=10),
+    },
+    "mutations": {
+        "EnableMutationTracking": MethodPolicy(timeout=10),
+        "DisableMutationTracking": MethodPolicy(timeout=10),
+        "ListMutations": MethodPolicy(timeout=10, retries=2, hedge_after=1),
+        "GetMutation": MethodPolicy(timeout=10, retries=2, hedge_after=1),
+        "PreviewRevertMutations": MethodPolicy(timeout=30, retries=1),
+        "RevertMutations": MethodPolicy(timeout=15 * 60),
+    }
+}
+
+
+class PooledChannel:
+    def __init__(self, endpoint, stub_cls):
+        self.endpoint = endpoint
+        self.channel = grpc.aio.insecure_channel(endpoint, options=CHANNEL_OPTIONS)
+        self.stub = stub_cls(self.channel)
+        self.outstanding = 0
+
+    def healthy(self):
+        return self.channel.get_state(try_to_connect=True) not in UNHEALTHY_STATES
+
+
+class ChannelPool:
+    """
+    Pool of grpc channels to one or more endpoints of a service
+
+    Every endpoint gets channels_per_endpoint channels, each with its own HTTP/2 connection, so a large transfer
+    only blocks the calls that are sent over the same connection. Calls are sent over the healthy channel with the
+    least outstanding calls ("least_outstanding") or over the healthy channels in turn ("round_robin").
+    If no channel is healthy, all channels are used.
+    """
+
+    def __init__(self, name, endpoints, stub_cls, channels_per_endpoint=1, balancing="least_outstanding"):
+        self.name = name
+        self.balancing = balancing
+        self.channels = [
+            PooledChannel(endpoint, stub_cls)
+            for endpoint in endpoints
+            for _ in range(channels_per_endpoint)
+        ]
+        self._next = itertools.count()
+
+        for i, channel in enumerate(self.channels):
+            metrics.gauge(
+                "rpc_outstanding_calls", lambda c=channel: c.outstanding,
+                service=name, endpoint=channel.endpoint, channel=str(i)
+            )
+
+    def pick(self, channels=None):
+        channels = channels or self.channels
+        channels = [c for c in channels if c.healthy()] or channels
+        offset = next(self._next)
+        # Rotate the channels so ties are not always resolved in favor of the first channel
+        channels = channels[offset % len(channels):] + channels[:offset % len(channels)]
+        if self.balancing == "round_robin":
+            return channels[0]
+
+        return min(channels, key=lambda c: c.outstanding)
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.channel.close()
+
+
+class PooledStub:
+    """
+    Drop-in replacement for a generated stub that sends every call over a channel of the pool
+
+    Calls are made according to the policy of the method, methods with retries or hedging return a coroutine instead
+    of a call object.
+    """
+
+    def __init__(self, pool, policies=None):
+        self._pool = pool
+        self._policies = policies or {}
+        # Outstanding calls per method, e.g. the backup loads that are currently running
+        self._in_flight = {}
+
+    def __getattr__(self, method):
+        policy = self._policies.get(method, DEFAULT_POLICY)
+
+        def _call(request, **kwargs):
+            if policy.timeout is not None:
+                kwargs.setdefault("timeout", policy.timeout)
+
+            if policy.retries or policy.hedge_after is not None:
+                return self._call_with_policy(method, policy, request, kwargs)
+
+            return self._send(method, self._pool.pick(), request, kwargs)
+
+        return _call
+
+    def _send(self, method, channel, request, kwargs):
+        call = getattr(channel.stub, method)(request, **kwargs)
+        started_at = time.perf_counter()
+        channel.outstanding += 1
+        self._set_in_flight(method, 1)
+        metrics.inc("rpc_calls_total", service=self._pool.name, method=method, endpoint=channel.endpoint)
+
+        def _done(_):
+            channel.outstanding -= 1
+            self._set_in_flight(method, -1)
+            metrics.observe(
+                "rpc_call_seconds", time.perf_counter() - started_at,
+                service=self._pool.name, method=method
+            )
+            asyncio.ensure_future(self._observe(method, call))
+
+        call.add_done_callback(_done)
+        return call
+
+    def _set_in_flight(self, method, delta):
+        count = self._in_flight[method] = self._in_flight.get(method, 0) + delta
+        metrics.set("rpc_in_flight_calls", count, service=self._pool.name, method=method)
+
+    async def _observe(self, method, call):
+        if await call.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+            metrics.inc("rpc_timeouts_total", service=self._pool.name, method=method)
+
+    async def _call_with_policy(self, method, policy, request, kwargs):
+        attempts = {}
+        error = None
+        try:
+            for attempt in range(policy.retries + 1):
+                if attempt > 0:
+                    metrics.inc("rpc_retries_total", service=self._pool.name, method=method)
+                    await asyncio.sleep(policy.backoff * 2 ** (attempt - 1))
+
+                channel = self._pool.pick()
+                call = self._send(method, channel, request, kwargs)
+                attempts[asyncio.ensure_future(call)] = call
+                hedged = policy.hedge_after is None
+                while attempts:
+                    done, _ = await asyncio.wait(
+                        attempts,
+                        timeout=None if hedged else policy.hedge_after,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if not done:
+                        # The attempt is slow, send a second one over another channel and take whichever is faster
+                        hedged = True
+                        metrics.inc("rpc_hedges_total", service=self._pool.name, method=method)
+                        others = [c for c in self._pool.channels if c is not channel]
+                        hedge = self._send(method, self._pool.pick(others), request, kwargs)
+                        attempts[asyncio.ensure_future(hedge)] = hedge
+                        continue
+
+                    for task in done:
+                        del attempts[task]
+                        if task.exception() is None:
+                            return task.result()
+
+                        error = task.exception()
+                        if not isinstance(error, AioRpcError) or error.code() not in RETRYABLE_CODES:
+                            raise error
+
+            raise error
+        finally:
+            for task, call in attempts.items():
+                call.cancel()
+                task.cancel()
+
+
+class RpcCollection:
+    def __init__(self):
+        balancing = config.RPC_BALANCING
+        per_endpoint = config.RPC_CHANNELS_PER_ENDPOINT
+
+        self.backups_pool = ChannelPool(
+            "backups", config.BACKUPS_SERVICES, backup_pb2_grpc.BackupServiceStub,
+            channels_per_endpoint=per_endpoint, balancing=balancing
+        )
+        self.backups = PooledStub(self.backups_pool, POLICIES["backups"])
+
+        self.mutations_pool = ChannelPool(
+            "mutations", config.MUTATIONS_SERVICES, mutation_pb2_grpc.MutationServiceStub,
+            channels_per_endpoint=per_endpoint, balancing=balancing
+        )
+        self.mutations = PooledStub(self.mutations_pool, POLICIES["mutations"])
@@ -6,6 +6,7 @@ from aiohttp import web
 import config
 from bot import Xenon
 from dbots.cmd import *
+from metrics import metrics
 from modules import backups, basics, settings, audit_logs, templates, premium, clone, export, mutations
 
 Format.ERROR.components = [ActionRow(
@@ -43,8 +44,22 @@ async def prepare_bot(*_):
     # await bot.push_commands()
 
 
+async def metrics_handler(_):
+    return web.Response(text=metrics.render(), content_type="text/plain")
+
+
+async def debug_vars_handler(_):
+    return web.json_response(metrics.snapshot())
+
+
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
-    loop.set_default_executor(ThreadPoolExecutor(max_workers=10))
-    app.add_routes([web.post("/entry", bot.aiohttp_entry)])
+    executor = ThreadPoolExecutor(max_workers=10)
+    loop.set_default_executor(executor)
+    metrics.gauge("executor_queue_depth", lambda: executor._work_queue.qsize())
+    app.add_routes([
+        web.post("/entry", bot.aiohttp_entry),
+        web.get("/metrics", metrics_handler),
+        web.get("/debug/vars", debug_vars_handler)
+    ])
     web.run_app(app, host=config.HOST, port=config.PORT)
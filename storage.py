@@ -0,0 +1,333 @@
+import hashlib
+import zlib
+
+import brotli
+import zstandard
+
+__all__ = (
+    "split_chunks",
+    "make_delta",
+    "apply_delta",
+    "CODECS",
+    "register_dictionary",
+    "has_dictionary",
+    "export_dictionaries",
+    "train_dictionary",
+    "compress_chunks",
+    "decompress_chunks",
+)
+
+CHUNK_MIN_SIZE = 32 * 1024
+CHUNK_MAX_SIZE = 256 * 1024
+# Cut after roughly one in 64 records once the minimum size has been reached
+CHUNK_MASK = 0x3F
+
+
+def _read_varint(raw, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(raw) or shift > 63:
+            raise ValueError("Truncated varint")
+
+        b = raw[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return result, pos
+
+        shift += 7
+
+
+def _record_ends(raw):
+    """
+    Yield the end offset of every top-level field in a serialized protobuf message
+    """
+    pos = 0
+    while pos < len(raw):
+        tag, pos = _read_varint(raw, pos)
+        wire_type = tag & 0x07
+        if wire_type == 0:
+            _, pos = _read_varint(raw, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(raw, pos)
+            pos += length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type}")
+
+        if pos > len(raw):
+            raise ValueError("Truncated field")
+
+        yield pos
+
+
+def _split_fixed(raw):
+    return [(i, min(i + CHUNK_MAX_SIZE, len(raw))) for i in range(0, len(raw), CHUNK_MAX_SIZE)]
+
+
+def _split_records(raw):
+    view = memoryview(raw)
+    result = []
+    start = 0
+    last = 0
+    for end in _record_ends(raw):
+        record = view[last:end]
+        last = end
+
+        size = end - start
+        if size >= CHUNK_MAX_SIZE:
+            # A single record can be larger than the max chunk size (e.g. a channel with a lot of messages)
+            while end - start > CHUNK_MAX_SIZE:
+                result.append((start, start + CHUNK_MAX_SIZE))
+                start += CHUNK_MAX_SIZE
+
+            result.append((start, end))
+            start = end
+        elif size >= CHUNK_MIN_SIZE and zlib.crc32(record) & CHUNK_MASK == 0:
+            result.append((start, end))
+            start = end
+
+    if start < len(raw):
+        result.append((start, len(raw)))
+
+    return result
+
+
+def split_chunks(raw):
+    """
+    Split a serialized BackupData into content-defined chunks
+
+    Chunk boundaries are only placed between top-level fields (channels, roles, members, ...) and are chosen based
+    on the content of the field, so adding or removing a channel only changes the chunk that contains it.
+    Returns a list of (sha256 hex digest, start, end) tuples in payload order.
+    """
+    try:
+        chunks = _split_records(raw)
+    except ValueError:
+        chunks = _split_fixed(raw)
+
+    view = memoryview(raw)
+    return [(hashlib.sha256(view[start:end]).hexdigest(), start, end) for start, end in chunks]
+
+
+def _is_repeated(field):
+    # FieldDescriptor.label has been removed in newer protobuf versions
+    if hasattr(field, "is_repeated"):
+        return field.is_repeated
+
+    return field.label == field.LABEL_REPEATED
+
+
+def _keyed_fields(message):
+    for field in message.DESCRIPTOR.fields:
+        if field.message_type is None or not _is_repeated(field):
+            continue
+
+        if field.message_type.GetOptions().map_entry:
+            yield field, True
+        elif "id" in field.message_type.fields_by_name:
+            yield field, False
+
+
+def make_delta(base, target):
+    """
+    Compute a structural delta that turns base into target
+
+    Returns a (partial, removed, order) tuple. partial is a copy of target in which keyed collections (channels,
+    roles, members, ...) only contain entries that were added or changed compared to base. removed maps the names of
+    the diffed collections to the keys that only exist in base. order maps the names of the diffed lists whose order
+    can't be derived from base (entries have been moved or inserted in between) to the ids of target in order.
+    Collections that can't be diffed exactly stay complete.
+    """
+    partial = type(target)()
+    partial.CopyFrom(target)
+    removed = {}
+    order = {}
+
+    for field, is_map in _keyed_fields(target):
+        base_items = getattr(base, field.name)
+        target_items = getattr(target, field.name)
+        partial_items = getattr(partial, field.name)
+
+        if is_map:
+            for key in list(partial_items.keys()):
+                if key in base_items and base_items[key] == target_items[key]:
+                    del partial_items[key]
+
+            removed[field.name] = [key for key in base_items if key not in target_items]
+            continue
+
+        base_by_id = {item.id: item for item in base_items}
+        target_ids = [item.id for item in target_items]
+        target_set = set(target_ids)
+        if len(base_by_id) != len(base_items) or len(target_set) != len(target_ids):
+            continue
+
+        changed = [item for item in target_items if base_by_id.get(item.id) != item]
+        del partial_items[:]
+        partial_items.extend(changed)
+        removed[field.name] = [i for i in base_by_id if i not in target_set]
+
+        # apply_delta keeps the order of base and appends new entries at the end, anything else is stored explicitly
+        kept = [i for i in base_by_id if i in target_set]
+        if target_ids != kept + [i for i in target_ids if i not in base_by_id]:
+            order[field.name] = target_ids
+
+    return partial, removed, order
+
+
+def apply_delta(base, partial, removed, order=None):
+    """
+    Reconstruct the target of make_delta from base and the delta
+    """
+    order = order or {}
+    result = type(partial)()
+    result.CopyFrom(partial)
+
+    for name, keys in removed.items():
+        field = result.DESCRIPTOR.fields_by_name[name]
+        keys = set(keys)
+        base_items = getattr(base, name)
+        result_items = getattr(result, name)
+
+        if field.message_type.GetOptions().map_entry:
+            scalar = field.message_type.fields_by_name["value"].message_type is None
+            for key, value in base_items.items():
+                if key in keys or key in result_items:
+                    continue
+
+                if scalar:
+                    result_items[key] = value
+                else:
+                    result_items[key].CopyFrom(value)
+
+            continue
+
+        changed = {item.id: item for item in getattr(partial, name)}
+        items = [changed.pop(item.id, item) for item in base_items if item.id not in keys]
+        items.extend(item for item in getattr(partial, name) if item.id in changed)
+        if name in order:
+            positions = {i: pos for pos, i in enumerate(order[name])}
+            items.sort(key=lambda item: positions[item.id])
+
+        del result_items[:]
+        result_items.extend(items)
+
+    return result
+
+
+ZSTD_LEVEL = 3
+ZSTD_DICT_SIZE = 112 * 1024
+
+_dictionaries = {}
+
+
+def register_dictionary(dict_id, data):
+    if dict_id not in _dictionaries:
+        dictionary = zstandard.ZstdCompressionDict(data)
+        dictionary.precompute_compress(level=ZSTD_LEVEL)
+        _dictionaries[dict_id] = dictionary
+
+
+def has_dictionary(dict_id):
+    return dict_id in _dictionaries
+
+
+def export_dictionaries(dict_ids):
+    """
+    Get the raw dictionaries so they can be registered in another process
+    """
+    return {
+        dict_id: _dictionaries[dict_id].as_bytes()
+        for dict_id in dict_ids
+        if dict_id in _dictionaries
+    }
+
+
+def _register_dictionaries(dictionaries):
+    for dict_id, data in (dictionaries or {}).items():
+        register_dictionary(dict_id, data)
+
+
+def train_dictionary(blobs, dictionaries=None):
+    """
+    Train a zstd dictionary on the content of blob documents
+
+    Returns a (dict id, dictionary bytes) tuple or None if there are not enough samples to train on.
+    """
+    samples = [decompress_chunks(blobs, [h], dictionaries) for h in blobs]
+    try:
+        dictionary = zstandard.train_dictionary(ZSTD_DICT_SIZE, samples, level=ZSTD_LEVEL)
+    except zstandard.ZstdError:
+        return None
+
+    return dictionary.dict_id(), dictionary.as_bytes()
+
+
+class BrotliCodec:
+    name = "brotli"
+
+    @staticmethod
+    def compress(raw, dict_id=None):
+        return brotli.compress(raw)
+
+    @staticmethod
+    def decompress(data, dict_id=None):
+        return brotli.decompress(data)
+
+
+class ZstdCodec:
+    name = "zstd"
+
+    @staticmethod
+    def compress(raw, dict_id=None):
+        if dict_id is None:
+            return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=_dictionaries[dict_id]).compress(raw)
+
+    @staticmethod
+    def decompress(data, dict_id=None):
+        if dict_id is None:
+            return zstandard.ZstdDecompressor().decompress(data)
+
+        return zstandard.ZstdDecompressor(dict_data=_dictionaries[dict_id]).decompress(data)
+
+
+CODECS = {codec.name: codec for codec in (BrotliCodec, ZstdCodec)}
+
+
+def compress_chunks(chunks, codec, dict_id=None, dictionaries=None):
+    """
+    Compress (hash, chunk) tuples into blob documents
+
+    dict_id is only used by codecs that support dictionaries. dictionaries are registered before compressing, this
+    is required when running in a worker process.
+    """
+    _register_dictionaries(dictionaries)
+    codec = CODECS[codec]
+    if codec is not ZstdCodec:
+        dict_id = None
+
+    return {
+        h: {
+            "data": codec.compress(chunk, dict_id),
+            "size": len(chunk),
+            "codec": codec.name,
+            "dict": dict_id
+        }
+        for h, chunk in chunks
+    }
+
+
+def decompress_chunks(blobs, hashes, dictionaries=None):
+    _register_dictionaries(dictionaries)
+    # Blobs without a codec have been written before codecs were configurable and always use brotli
+    return b"".join(
+        CODECS[blobs[h].get("codec", "brotli")].decompress(blobs[h]["data"], blobs[h].get("dict"))
+        for h in hashes
+    )
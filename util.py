@@ -1,16 +1,35 @@
+import asyncio
+import functools
+import hashlib
+import math
+import sys
+import time
+import traceback
+from collections import OrderedDict
 from enum import IntEnum
 
 import config
 from dbots.cmd import Check
+from metrics import metrics
 
 __all__ = (
     "PremiumLevel",
     "premium_required",
     "entitlement_required",
     "PREMIUM_REQUIRED_TEXT",
-    "can_upsell"
+    "can_upsell",
+    "LRUCache",
+    "AdaptiveLimiter",
+    "BloomFilter",
+    "MembershipFilter",
+    "InteractionDeadline",
+    "auto_defer"
 )
 
+# Discord requires an initial response within 3 seconds, slower handlers get a deferred response after DEFER_AFTER
+DEFER_AFTER = 2.5
+DISCORD_EPOCH = 1420070400000
+
 PREMIUM_REQUIRED_TEXT = "You **need** to buy **Xenon Premium** to be able to use this bot and its commands.\n\n" \
                         "You can **buy Premium [here](<https://patreon.com/merlinfuchs>)** and " \
                         "get a full list of features [here](<https://wiki.xenon.bot/premium>).\n\n\n" \
@@ -54,3 +73,295 @@ async def entitlement_required(ctx, **_):
         return False
 
     return True
+
+
+class LRUCache:
+    """
+    Least recently used cache that is bounded by the total size of its values
+
+    size is called with every value to get its size, by default every value has a size of 1.
+    Entries that are older than ttl seconds are treated as missing.
+    """
+
+    def __init__(self, name, max_size, size=None, ttl=None):
+        self.name = name
+        self.max_size = max_size
+        self.size = size or (lambda _: 1)
+        self.ttl = ttl
+        self.current_size = 0
+        self._entries = OrderedDict()
+
+        metrics.gauge("cache_size", lambda: self.current_size, cache=name)
+        metrics.gauge("cache_entries", lambda: len(self._entries), cache=name)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or (entry[2] is not None and entry[2] < time.monotonic()):
+            metrics.inc("cache_misses_total", cache=self.name)
+            return default
+
+        self._entries.move_to_end(key)
+        metrics.inc("cache_hits_total", cache=self.name)
+        return entry[0]
+
+    def set(self, key, value):
+        self.delete(key)
+
+        size = self.size(value)
+        if size > self.max_size:
+            return
+
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._entries[key] = (value, size, expires_at)
+        self.current_size += size
+
+        while self.current_size > self.max_size:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.current_size -= evicted_size
+            metrics.inc("cache_evictions_total", cache=self.name)
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.current_size -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self.current_size = 0
+
+
+class AdaptiveLimiter:
+    """
+    Concurrency limiter that adapts its limit to the health of a backend (AIMD)
+
+    The limit grows by roughly one for every limit calls that complete within target_latency seconds while the limiter
+    is saturated and is halved when the backend reports that it is overloaded. The limit is halved at most once per
+    target_latency seconds so a burst of errors from calls that were started together only counts once.
+    """
+
+    def __init__(self, name, initial, min_limit=1, max_limit=100, target_latency=30):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.active = 0
+        self.waiting = 0
+        self._waiters = []
+        self._decreased_at = 0
+
+        metrics.gauge("limiter_limit", lambda: int(self.limit), limiter=name)
+        metrics.gauge("limiter_active", lambda: self.active, limiter=name)
+        metrics.gauge("limiter_waiting", lambda: self.waiting, limiter=name)
+
+    def locked(self):
+        return self.active >= int(self.limit)
+
+    async def acquire(self):
+        while self.locked():
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            self.waiting += 1
+            try:
+                await waiter
+            finally:
+                self.waiting -= 1
+
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def _wake(self):
+        # Woken up waiters check the limit again
+        free = max(int(self.limit) - self.active, 0)
+        for waiter in self._waiters[:free]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+        del self._waiters[:free]
+
+    def success(self, latency):
+        metrics.inc("limiter_completed_total", limiter=self.name, result="success")
+        if latency > self.target_latency:
+            metrics.inc("limiter_slow_total", limiter=self.name)
+            return
+
+        # Only grow when the current limit is actually being used
+        if self.active >= int(self.limit):
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self._wake()
+
+    def overload(self):
+        metrics.inc("limiter_completed_total", limiter=self.name, result="overload")
+        now = time.monotonic()
+        if now - self._decreased_at < self.target_latency:
+            return
+
+        self._decreased_at = now
+        self.limit = max(self.limit / 2, self.min_limit)
+
+
+class BloomFilter:
+    """
+    Probabilistic set that never has false negatives and has false positives at roughly error_rate
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / max(capacity, 1) * math.log(2)), 1)
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, key):
+        return all(self.bits[pos // 8] & (1 << (pos % 8)) for pos in self._positions(key))
+
+
+class MembershipFilter:
+    """
+    Set of ids that answers "definitely not a member" without a database lookup
+
+    Up to exact_limit ids are kept in a set, larger lists are kept in a bloom filter. Positive answers can be wrong
+    (false positives or ids that have been removed from a bloom filter) and must be confirmed by the caller.
+    """
+
+    def __init__(self, ids=(), exact_limit=100000):
+        ids = {str(i) for i in ids}
+        if len(ids) <= exact_limit:
+            self.ids = ids
+        else:
+            # Leave room for additions until the next reload
+            self.ids = BloomFilter(len(ids) * 2)
+            for i in ids:
+                self.ids.add(i)
+
+    def add(self, key):
+        self.ids.add(str(key))
+
+    def discard(self, key):
+        # Bloom filters don't support removals, the removed id keeps being confirmed by the caller until the next reload
+        if isinstance(self.ids, set):
+            self.ids.discard(str(key))
+
+    def __contains__(self, key):
+        return str(key) in self.ids
+
+
+class InteractionDeadline:
+    """
+    Time that is left to send the initial response of an interaction
+
+    The deadline is counted from the creation of the interaction (its snowflake) or from its receipt, whichever is
+    earlier. If the response is deferred automatically, on_finish is called with the duration of the handler once it
+    is done.
+    """
+
+    def __init__(self, name, interaction_id, on_finish=None, defer_after=DEFER_AFTER):
+        created_at = ((int(interaction_id) >> 22) + DISCORD_EPOCH) / 1000
+        self.name = name
+        self.on_finish = on_finish
+        self.started_at = time.monotonic()
+        self.defer_at = self.started_at + defer_after - max(time.time() - created_at, 0)
+        self.deferred = False
+
+    def finish(self):
+        if self.deferred and self.on_finish is not None:
+            self.on_finish(time.monotonic() - self.started_at)
+
+
+class _DeadlineContext:
+    # Forwards everything to the context and keeps track of whether the initial response has been sent
+
+    def __init__(self, ctx, deadline, ephemeral):
+        self._ctx = ctx
+        self._deadline = deadline
+        self._ephemeral = ephemeral
+        self._responded = False
+
+    def __getattr__(self, item):
+        return getattr(self._ctx, item)
+
+    def respond(self, *args, **kwargs):
+        self._responded = True
+        return self._ctx.respond(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        self._responded = True
+        return self._ctx.update(*args, **kwargs)
+
+    def upsell(self, *args, **kwargs):
+        self._responded = True
+        return self._ctx.upsell(*args, **kwargs)
+
+    def defer(self, *args, **kwargs):
+        # The handler might defer on its own after it has been deferred automatically
+        if self._deadline.deferred:
+            return
+
+        self._responded = True
+        return self._ctx.defer(*args, **kwargs)
+
+    def defer_if_pending(self):
+        if self._responded:
+            return
+
+        self._responded = True
+        self._deadline.deferred = True
+        metrics.inc("interactions_deferred_total", command=self._deadline.name)
+        try:
+            if self._ephemeral is None:
+                self._ctx.defer()
+            else:
+                self._ctx.defer(ephemeral=self._ephemeral)
+        except Exception as e:
+            tb = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+            print(f"Defer Error ({self._deadline.name}):\n", tb, file=sys.stderr)
+
+
+def auto_defer(ephemeral=None):
+    """
+    Defer the response of a handler if it hasn't responded shortly before the deadline of the interaction
+
+    Commands pass whether the deferred response is ephemeral, it must match the responses of the handler because it
+    can't be changed afterwards. Components are deferred as an update of their message (ephemeral=None).
+    The handler keeps running and its responses are sent through the context as usual.
+
+    Every handler that does database, RPC or API calls before its initial response is decorated, except:
+    - components that respond with a new message (change_info, backup_info_direct), their late response would
+      replace the message of the component instead
+    - handlers that defer on their own (/changes list, change_list)
+    - change_revert, which updates its message before calling the mutations service
+    - the bot owner commands of the admin module
+    """
+
+    def _decorator(func):
+        @functools.wraps(func)
+        async def _wrapper(self, ctx, *args, **kwargs):
+            deadline = getattr(ctx, "deadline", None)
+            if deadline is None:
+                return await func(self, ctx, *args, **kwargs)
+
+            ctx = _DeadlineContext(ctx, deadline, ephemeral)
+            timer = asyncio.get_running_loop().call_later(
+                max(deadline.defer_at - time.monotonic(), 0),
+                ctx.defer_if_pending
+            )
+            try:
+                return await func(self, ctx, *args, **kwargs)
+            finally:
+                timer.cancel()
+                deadline.finish()
+
+        return _wrapper
+
+    return _decorator